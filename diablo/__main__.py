@@ -43,9 +43,12 @@ def main():
     if args.command == 'host':
         Server.start_server()
     elif args.command == 'connect':
-        start_client()
+        start_client(args.server_ip)
     elif args.command == 'stop':
         Server.stop_server()
+    elif args.command == 'status':
+        from .status import Status
+        Status.print_status()
     elif args.command == 'restart':
         from .restart import restart
         restart()
@@ -0,0 +1,302 @@
+"""
+ARP protection for the LAN interface, set with these options in config.json:
+
+    "monitor_arp_requests"  watch ARP traffic and warn when an address changes hands
+                            (the usual sign of ARP spoofing)
+    "block_arp_requests"    client only, drop ARP requests from anyone but the server and
+                            the LAN gateways so the client can't be found with an ARP scan
+    "spoof_arp"             server only, turn on the kernel's proxy ARP on the LAN interface so
+                            it answers for the tunnel addresses. Nothing is forged, replies are
+                            the kernel's own and only for addresses routed through the server
+    "manipulate_arp_response"  not supported, a warning is printed when it is set
+
+The watcher reads an AF_PACKET socket with a classic BPF program attached.
+The kernel drops everything that isn't an Ethernet / IPv4 ARP frame and
+only copies the first 42 bytes of the rest, so a broadcast storm of other
+traffic costs nothing here. Frames are read without blocking until the
+socket runs dry after each wakeup, into one preallocated buffer. The table
+maps each IPv4 address to the MAC that last claimed it, so every frame costs
+one dict lookup. Alerts are rate limited per address so a flood of forged
+replies doesn't flood the log too.
+"""
+import time
+import ctypes
+import select
+import socket
+import struct
+import threading
+from .terminal import Terminal
+from .firewall import nft_available, load_rules, delete_table
+from .audit import Audit, ARP_CONFLICT
+
+ETH_P_ARP = 0x0806
+ARP_FRAME = 42              # Ethernet header + ARP for IPv4 over Ethernet
+SO_ATTACH_FILTER = 26
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+RECEIVE_BUFFER = 1024 * 1024
+RTF_GATEWAY = 0x2
+POLL_WAKEUP = 1000          # ms, how often the watcher checks whether it should stop
+
+MAX_ENTRIES = 4096          # oldest address is forgotten beyond this
+CONFLICT_WINDOW = 300       # seconds, a different MAC within this long of the last one is a conflict
+ALERT_INTERVAL = 60         # seconds between warnings about the same address
+RECENT_CONFLICTS = 8
+
+ARP_TABLE = "arp diablo"
+
+# Classic BPF, (code, jt, jf, k): accept Ethernet / IPv4 ARP with 6 byte MACs and 4 byte addresses
+BPF_PROGRAM = (
+    (0x28, 0, 0, 12),           # ldh [12]          ethertype
+    (0x15, 0, 7, ETH_P_ARP),    # jeq #0x0806
+    (0x28, 0, 0, 14),           # ldh [14]          hardware type
+    (0x15, 0, 5, 1),            # jeq #1 (Ethernet)
+    (0x28, 0, 0, 16),           # ldh [16]          protocol type
+    (0x15, 0, 3, 0x0800),       # jeq #0x0800 (IPv4)
+    (0x28, 0, 0, 18),           # ldh [18]          hardware / protocol address length
+    (0x15, 0, 1, 0x0604),       # jeq #0x0604
+    (0x06, 0, 0, ARP_FRAME),    # ret #42           accept, truncated
+    (0x06, 0, 0, 0),            # ret #0            drop
+)
+
+def attach_filter(sock, program=BPF_PROGRAM):
+    """ SO_ATTACH_FILTER with a classic BPF program, the buffer has to outlive the call only """
+    code = b"".join(struct.pack("HBBI", *instruction) for instruction in program)
+    buffer = ctypes.create_string_buffer(code)
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+def lan_interface(destination=None):
+    """
+    Interface the route to destination (an IPv4 string) goes out of, the
+    default route's if destination is None. Read from /proc/net/route, None
+    if it can't be worked out.
+    """
+    target = struct.unpack("<I", socket.inet_aton(destination))[0] if destination else 0
+    best, best_mask = None, -1
+    try:
+        with open("/proc/net/route") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                network, mask = int(fields[1], 16), int(fields[7], 16)
+                # Masks are little endian like the addresses, compare the number of bits
+                if target & mask == network and bin(mask).count("1") > best_mask:
+                    best, best_mask = fields[0], bin(mask).count("1")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+    return best
+
+def gateways(interface):
+    """ Next-hop gateways of every route out of interface, as IPv4 strings, from /proc/net/route """
+    found = []
+    try:
+        with open("/proc/net/route") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[0] == interface and int(fields[3], 16) & RTF_GATEWAY:
+                    gateway = socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+                    if gateway not in found:
+                        found.append(gateway)
+    except (OSError, ValueError, IndexError, StopIteration):
+        pass
+    return found
+
+def _format_mac(mac):
+    return ":".join(f"{octet:02x}" for octet in mac)
+
+
+class ArpWatcher:
+    """ IPv4 address -> MAC table of one interface, fed by run() in its own thread """
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.table = {}         # sender IP (4 bytes) -> [MAC (6 bytes), last seen]
+        self.alerted = {}       # sender IP -> when we last warned about it
+        self.frames = 0
+        self.conflicts = 0
+        self.mismatched = 0     # ARP sender MAC differs from the Ethernet source
+        self.dropped = 0        # frames the kernel dropped because we fell behind
+        self.recent = []        # last RECENT_CONFLICTS conflicts for 'diablo status'
+        self.sock = None
+
+    def open(self):
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+        try:
+            attach_filter(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+            sock.bind((self.interface, ETH_P_ARP))
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def observe(self, frame, now):
+        """ Update the table from one ARP frame (a memoryview of at least ARP_FRAME bytes) """
+        sender_ip = bytes(frame[28:32])
+        if sender_ip == b"\0\0\0\0":
+            return  # address probe, nobody claims anything yet
+        sender_mac = bytes(frame[22:28])
+        if frame[6:12] != sender_mac:
+            self.mismatched += 1
+        entry = self.table.get(sender_ip)
+        if entry is None:
+            if len(self.table) >= MAX_ENTRIES:
+                del self.table[next(iter(self.table))]
+            self.table[sender_ip] = [sender_mac, now]
+            return
+        if entry[0] != sender_mac:
+            if now - entry[1] < CONFLICT_WINDOW:
+                self._conflict(sender_ip, entry[0], sender_mac, now)
+            entry[0] = sender_mac
+        entry[1] = now
+
+    def _conflict(self, ip, previous, mac, now):
+        self.conflicts += 1
+        Audit.record(ARP_CONFLICT, a=ip, count_a=int.from_bytes(previous, "big"), count_b=int.from_bytes(mac, "big"))
+        address = socket.inet_ntoa(ip)
+        self.recent = (self.recent + [{"ip": address, "mac": _format_mac(mac), "previous": _format_mac(previous),
+                                       "at": int(time.time())}])[-RECENT_CONFLICTS:]
+        if now - self.alerted.get(ip, -ALERT_INTERVAL) >= ALERT_INTERVAL:
+            self.alerted[ip] = now
+            Terminal.warn(f"ARP: {address} moved from {_format_mac(previous)} to {_format_mac(mac)} on "
+                          f"{self.interface}, possible ARP spoofing")
+
+    def run(self, stop):
+        buffer = bytearray(ARP_FRAME)
+        view = memoryview(buffer)
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        try:
+            while not stop.is_set():
+                if not poller.poll(POLL_WAKEUP):
+                    continue
+                now = time.monotonic()
+                while True:
+                    try:
+                        length = self.sock.recv_into(buffer, ARP_FRAME, socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        break
+                    if length == ARP_FRAME:
+                        self.frames += 1
+                        self.observe(view, now)
+        except OSError as e:
+            if not stop.is_set():
+                Terminal.error(f"ARP watcher on {self.interface} stopped: {e}", exit=False)
+        finally:
+            self.sock.close()
+
+    def _kernel_drops(self):
+        """ From PACKET_STATISTICS, which resets the counters on every read """
+        try:
+            _, drops = struct.unpack("II", self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+        except OSError:
+            return 0
+        return drops
+
+    def stats(self):
+        self.dropped += self._kernel_drops()
+        return {
+            "interface": self.interface,
+            "hosts": len(self.table),
+            "frames": self.frames,
+            "conflicts": self.conflicts,
+            "mismatched": self.mismatched,
+            "dropped": self.dropped,
+            "recent": self.recent,
+        }
+
+
+class ArpProtection:
+    """
+    ARP options of one server or client. apply() changes the system (proxy
+    ARP, nftables), start_watching(stop) starts the watcher thread and
+    remove() undoes everything apply() did. peer is the server's address on a
+    client, while blocking ARP requests from it and the LAN gateways still
+    get through.
+    """
+
+    def __init__(self, config, server=False, peer=None):
+        self.server = server
+        self.peer = peer
+        self.interface = lan_interface(peer)
+        self.monitor = config.get("monitor_arp_requests", False)
+        self.block = not server and config.get("block_arp_requests", False)
+        self.proxy = server and config.get("spoof_arp", False)
+        if config.get("manipulate_arp_response", False):
+            Terminal.warn("ARP: manipulate_arp_response is not supported and has no effect, "
+                          "spoof_arp turns on proxy ARP on the server instead")
+        self.watcher = None
+        self.blocking = False
+        self.proxy_previous = None
+
+    def _proxy_arp_path(self):
+        return f"/proc/sys/net/ipv4/conf/{self.interface}/proxy_arp"
+
+    def apply(self):
+        if self.interface is None:
+            if self.monitor or self.block or self.proxy:
+                Terminal.warn("ARP: no LAN interface found, ARP protection is off")
+            return
+        if self.proxy:
+            try:
+                with open(self._proxy_arp_path(), "r+") as f:
+                    self.proxy_previous = f.read().strip()
+                    f.seek(0)
+                    f.write("1")
+                Terminal.log(f"ARP: answering for tunnel addresses on {self.interface}")
+            except OSError as e:
+                Terminal.warn(f"ARP: could not enable proxy ARP on {self.interface}: {e}")
+        if self.block:
+            self._block_requests()
+
+    def _block_requests(self):
+        if not nft_available():
+            Terminal.warn("ARP: nft not found, ARP requests are not blocked")
+            return
+        # The gateways have to keep resolving us, the tunnel itself usually runs through one
+        allowed = ([self.peer] if self.peer else []) + [gateway for gateway in gateways(self.interface)
+                                                         if gateway != self.peer]
+        allow = f"arp saddr ip != {{ {', '.join(allowed)} }} " if allowed else ""
+        try:
+            load_rules([
+                f"add table {ARP_TABLE}",
+                f"delete table {ARP_TABLE}",
+                f"table {ARP_TABLE} {{",
+                "    chain input { type filter hook input priority 0; policy accept;",
+                f'        iifname "{self.interface}" arp operation request {allow}counter drop }}',
+                "}",
+            ])
+        except (OSError, RuntimeError) as e:
+            Terminal.warn(f"ARP: could not block ARP requests: {e}")
+            return
+        self.blocking = True
+        Terminal.log(f"ARP: dropping ARP requests on {self.interface}")
+
+    def start_watching(self, stop):
+        if not self.monitor or self.interface is None:
+            return
+        watcher = ArpWatcher(self.interface)
+        try:
+            watcher.open()
+        except OSError as e:
+            Terminal.warn(f"ARP: could not watch {self.interface}: {e}")
+            return
+        self.watcher = watcher
+        threading.Thread(target=watcher.run, args=(stop,), name="arp_watcher", daemon=True).start()
+
+    def stats(self):
+        return self.watcher.stats() if self.watcher is not None else None
+
+    def remove(self):
+        if self.blocking:
+            delete_table(ARP_TABLE)
+            self.blocking = False
+        if self.proxy_previous is not None:
+            try:
+                with open(self._proxy_arp_path(), "w") as f:
+                    f.write(self.proxy_previous)
+            except OSError:
+                pass
+            self.proxy_previous = None
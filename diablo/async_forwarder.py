@@ -0,0 +1,416 @@
+"""
+asyncio data plane. Instead of two blocking threads per tunnel, every TUN fd and
+TLS socket is registered with a single event loop (add_reader / add_writer) and
+driven with non-blocking reads and writes, so one process can multiplex many
+tunnels. Selected with "data_plane": "asyncio" in config.json.
+"""
+import os
+import ssl
+import signal
+import socket
+import asyncio
+from collections import deque
+from .terminal import Terminal
+from .protocol import FrameReader, encode_frame, FRAME_HEADER, FRAME_DATA, FRAME_CONTROL, FRAME_COMPRESSED, HEADER_SIZE
+from .sessions import packet_source
+from .forwarder import decompress_frame, TunWriter
+from .tun import DEFAULT_MTU
+from .buffers import BufferRing
+from .shaping import FairQueue
+
+HIGH_WATERMARK = 256 * 1024
+READ_BUDGET = 64 * 1024     # per wakeup, so one busy client can't keep the loop to itself
+
+class AsyncConnection:
+    """
+    Non-blocking framed TLS connection on the event loop. Outgoing frames are
+    copied into buffers taken from a shared BufferRing and sent straight from
+    there, callers keep the queue bounded with has_room(). Incoming frames are
+    reassembled in a fixed size FrameReader, COMPRESSED ones are expanded
+    with compressor before they reach on_packet.
+    """
+
+    def __init__(self, loop, tls_socket, on_packet, on_control=None, on_drained=None,
+                 high_watermark=HIGH_WATERMARK, mtu=DEFAULT_MTU, ring=None, compressor=None):
+        self.loop = loop
+        self.sock = tls_socket
+        self.sock_fd = tls_socket.fileno()
+        self.on_packet = on_packet
+        self.on_control = on_control
+        self.on_drained = on_drained
+        self.reader = FrameReader(max_payload=mtu)
+        self.ring = ring if ring is not None else BufferRing()
+        self.compressor = compressor
+        self.pending = deque()  # Buffers, only the last one is still being filled
+        self.queued = 0
+        self.in_flight = 0
+        self.writing = False
+        self.paused = False
+        self.high_watermark = high_watermark
+        self.low_watermark = high_watermark // 4
+        self.congested = False
+        self.closed = loop.create_future()
+
+    @property
+    def backlog(self):
+        return self.queued
+
+    def has_room(self):
+        """ False from the moment the queue reaches the high watermark until it drains to the low one """
+        if self.congested and self.queued <= self.low_watermark:
+            self.congested = False
+        elif not self.congested and self.queued >= self.high_watermark:
+            self.congested = True
+        return not self.congested
+
+    def start(self):
+        self.sock.setblocking(False)
+        self.loop.add_reader(self.sock_fd, self._on_readable)
+        if self.sock.pending():
+            self.loop.call_soon(self._on_readable)
+        return self.closed
+
+    def pause_reading(self, delay):
+        """ Stop reading for delay seconds, meanwhile TCP flow control pushes back on the peer """
+        if self.paused or self.closed.done():
+            return
+        self.paused = True
+        self.loop.remove_reader(self.sock_fd)
+        self.loop.call_later(delay, self._resume_reading)
+
+    def _resume_reading(self):
+        self.paused = False
+        if not self.closed.done():
+            self.loop.add_reader(self.sock_fd, self._on_readable)
+            if self.sock.pending():
+                self.loop.call_soon(self._on_readable)
+
+    def close(self, reason=None):
+        if self.closed.done():
+            return
+        self.loop.remove_reader(self.sock_fd)
+        self.loop.remove_writer(self.sock_fd)
+        while self.pending:
+            self.ring.release(self.pending.popleft())
+        self.queued = 0
+        self.closed.set_result(reason)
+
+    def queue(self, frame):
+        """
+        Queue a frame without sending it yet, call flush() once the batch is
+        complete. Returns False if it was dropped because the ring is exhausted.
+        """
+        if self.closed.done():
+            return False
+        tail = self.pending[-1] if self.pending else None
+        # Appending past end is safe even during a retried write, the bytes in flight don't move
+        if tail is None or tail.room < len(frame):
+            tail = self.ring.acquire()
+            if tail is None:
+                return False
+            self.pending.append(tail)
+        tail.append(frame)
+        self.queued += len(frame)
+        return True
+
+    def queue_packet(self, frame, packet):
+        """ queue() the DATA frame of packet, or a COMPRESSED frame if compression pays off """
+        if self.compressor is not None:
+            frame = self.compressor.frame(packet) or frame
+        return self.queue(frame)
+
+    def send_control(self, payload):
+        self.queue(encode_frame(FRAME_CONTROL, payload))
+        self.flush()
+
+    def flush(self):
+        """ Push queued frames into the non-blocking SSL socket until it would block """
+        while self.pending and not self.closed.done():
+            head = self.pending[0]
+            # After SSLWantWrite OpenSSL expects the exact same write to be retried
+            size = self.in_flight or head.pending
+            try:
+                sent = self.sock.send(head.view[head.start:head.start + size])
+            except (ssl.SSLWantWriteError, BlockingIOError):
+                self.in_flight = size
+                self._want_write(True)
+                return
+            except ssl.SSLWantReadError:
+                self.in_flight = size
+                return
+            except OSError as e:
+                self.close(f"TLS send failed: {e}")
+                return
+            self.in_flight = 0
+            head.start += sent
+            self.queued -= sent
+            if not head.pending:
+                self.ring.release(self.pending.popleft())
+        self._want_write(False)
+        if self.on_drained is not None and self.queued <= self.low_watermark and not self.closed.done():
+            self.on_drained()
+
+    def _want_write(self, enabled):
+        if enabled and not self.writing:
+            self.loop.add_writer(self.sock_fd, self.flush)
+        elif not enabled and self.writing:
+            self.loop.remove_writer(self.sock_fd)
+        self.writing = enabled
+
+    def _on_readable(self):
+        # Keep reading while OpenSSL still holds decrypted bytes, the fd won't fire again for them
+        budget = READ_BUDGET
+        while not self.closed.done() and not self.paused:
+            if budget <= 0:
+                if self.sock.pending():
+                    self.loop.call_soon(self._on_readable)
+                break
+            try:
+                received = self.reader.fill(self.sock)
+            except (ssl.SSLWantReadError, BlockingIOError):
+                break
+            except ssl.SSLWantWriteError:
+                self._want_write(True)
+                break
+            except OSError as e:
+                self.close(f"TLS receive failed: {e}")
+                return
+            if not received:
+                self.close("connection closed")
+                return
+            budget -= received
+            try:
+                for frame_type, payload in self.reader.frames():
+                    if frame_type == FRAME_DATA:
+                        self.on_packet(payload)
+                    elif frame_type == FRAME_COMPRESSED:
+                        self.on_packet(decompress_frame(self.compressor, payload))
+                    elif frame_type == FRAME_CONTROL and self.on_control is not None:
+                        self.on_control(payload)
+            except Exception as e:
+                self.close(f"Bad frame from peer: {e}")
+                return
+        if self.pending:
+            self.flush()
+
+
+class AsyncEngine:
+    """
+    Event loop owning any number of tunnels, stops on SIGINT / SIGTERM / SIGHUP.
+    Clients use add_tunnel (one TUN fd per connection). The server attaches its
+    single TUN device with attach_tun and adds one session per client; packets
+    read from the TUN are routed to sessions by destination address.
+    """
+
+    def __init__(self, max_batch=32, queue_bytes=HIGH_WATERMARK, mtu=DEFAULT_MTU, ring=None):
+        self.loop = asyncio.new_event_loop()
+        self.max_batch = max_batch
+        self.queue_bytes = queue_bytes
+        self.mtu = mtu
+        self.ring = ring if ring is not None else BufferRing()
+        # Every TUN read lands behind a DATA header in this buffer, queue() copies it into the ring
+        self.frame = bytearray(HEADER_SIZE + mtu)
+        self.frame_view = memoryview(self.frame)
+        self.connections = set()
+        self.tun_fds = []
+        self.tun_writers = {}   # tun fd -> TunWriter
+        self.tun_queues = {}    # tun fd -> FairQueue of client packets waiting to be written to it
+        self.draining = set()
+        self.stopping = self.loop.create_future()
+
+    def _track(self, connection):
+        self.connections.add(connection)
+        connection.start().add_done_callback(lambda _: self.connections.discard(connection))
+
+    def _read_tun(self, tun_fd, on_frame):
+        """
+        Up to max_batch packets from a non-blocking TUN fd. Each one is read into
+        the preallocated frame buffer and passed to on_frame(frame, packet) as
+        views that are only valid during the call. Returns the packet count.
+        """
+        packet_view = self.frame_view[HEADER_SIZE:]
+        count = 0
+        for _ in range(self.max_batch):
+            try:
+                length = os.readv(tun_fd, [packet_view])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.stop(f"TUN read failed: {e}")
+                break
+            if length:
+                FRAME_HEADER.pack_into(self.frame, 0, length, FRAME_DATA)
+                on_frame(self.frame_view[:HEADER_SIZE + length], packet_view[:length])
+                count += 1
+        return count
+
+    def _write_tun(self, tun_fd, packet):
+        try:
+            self.tun_writers[tun_fd].write(packet)
+        except OSError as e:
+            self.stop(f"TUN write failed: {e}")
+
+    def _watch_tun(self, tun_fd, callback):
+        os.set_blocking(tun_fd, False)
+        self.loop.add_reader(tun_fd, callback)
+        self.tun_fds.append(tun_fd)
+        self.tun_writers[tun_fd] = TunWriter(tun_fd)
+
+    def tun_dropped(self):
+        """ Packets dropped so far because a TUN device's queue was full """
+        return sum(writer.dropped for writer in self.tun_writers.values())
+
+    def add_tunnel(self, tun_fd, tls_socket, on_control=None, compressor=None):
+        """
+        Point to point tunnel. Once the TLS socket's queue hits its high watermark
+        the TUN device isn't read until the queue drains below the low watermark.
+        """
+        paused = False
+
+        def on_tun_readable():
+            nonlocal paused
+            if not self._read_tun(tun_fd, connection.queue_packet):
+                return
+            connection.flush()
+            if not paused and not connection.has_room():
+                self.loop.remove_reader(tun_fd)
+                paused = True
+
+        def on_drained():
+            nonlocal paused
+            if paused:
+                self.loop.add_reader(tun_fd, on_tun_readable)
+                paused = False
+
+        connection = AsyncConnection(self.loop, tls_socket, lambda packet: self._write_tun(tun_fd, packet),
+                                     on_control, on_drained, self.queue_bytes, self.mtu, self.ring, compressor)
+        self._watch_tun(tun_fd, on_tun_readable)
+        self._track(connection)
+        connection.closed.add_done_callback(lambda _: paused or self.loop.remove_reader(tun_fd))
+        return connection
+
+    def attach_tun(self, tun_fd, sessions, packet_filter=None, flows=None):
+        """
+        Shared server TUN device. The reader is never paused for one client, packets
+        for a congested session (see AsyncConnection.has_room) are dropped instead,
+        as are packets packet_filter rejects.
+        """
+        touched = set()
+
+        def on_frame(frame, packet):
+            session = sessions.route(packet)
+            if session is None or session.channel is None:
+                return
+            if packet_filter is not None and not packet_filter.allows(packet, True):
+                session.blocked += 1
+                return
+            if flows is not None:
+                flows.count(packet, True)
+            if session.egress is not None and not session.egress.allow(len(packet)):
+                session.dropped += 1
+                return
+            if not session.channel.has_room() or not session.channel.queue_packet(frame, packet):
+                session.dropped += 1
+                return
+            touched.add(session.channel)
+
+        def on_tun_readable():
+            if packet_filter is not None:
+                packet_filter.refresh()
+            self._read_tun(tun_fd, on_frame)
+            for channel in touched:
+                channel.flush()
+            touched.clear()
+
+        self._watch_tun(tun_fd, on_tun_readable)
+
+    def _drain(self, tun_fd):
+        self.draining.discard(tun_fd)
+        self.tun_queues[tun_fd].drain(lambda packet: self._write_tun(tun_fd, packet))
+
+    def add_session(self, session, tun_fd, on_closed=None, on_control=None, packet_filter=None, flows=None):
+        """
+        Must run on the loop thread, use loop.call_soon_threadsafe from the accept
+        loop. Packets from the client go through a FairQueue in front of the TUN
+        device, drained once the current batch of readable sockets has been read.
+        A client over its ingress rate isn't read from until it is back in budget.
+        """
+        tun_queue = self.tun_queues.get(tun_fd)
+        if tun_queue is None:
+            tun_queue = self.tun_queues[tun_fd] = FairQueue(self.mtu, self.queue_bytes)
+
+        def on_packet(packet):
+            if packet_source(packet) != session.address:
+                return
+            if packet_filter is not None:
+                packet_filter.refresh()
+                if not packet_filter.allows(packet, False):
+                    session.blocked += 1
+                    return
+            if flows is not None:
+                flows.count(packet, False)
+            if not tun_queue.put(session, packet):
+                session.dropped += 1
+            if tun_fd not in self.draining:
+                self.draining.add(tun_fd)
+                self.loop.call_soon(self._drain, tun_fd)
+            if session.ingress is not None:
+                wait = session.ingress.charge(len(packet))
+                if wait:
+                    session.channel.pause_reading(wait)
+
+        control = (lambda payload: on_control(session, payload)) if on_control is not None else None
+        session.channel = AsyncConnection(self.loop, session.conn, on_packet, control,
+                                          high_watermark=self.queue_bytes, mtu=session.mtu, ring=self.ring,
+                                          compressor=session.compressor)
+        self._track(session.channel)
+        session.channel.closed.add_done_callback(lambda _: tun_queue.remove(session))
+        if on_closed is not None:
+            session.channel.closed.add_done_callback(lambda _: on_closed(session))
+        return session.channel
+
+    def stop(self, reason):
+        if not self.stopping.done():
+            self.stopping.set_result(reason)
+
+    def stop_threadsafe(self, reason):
+        try:
+            self.loop.call_soon_threadsafe(self.stop, reason)
+        except RuntimeError:
+            pass  # loop already closed, nothing left to stop
+
+    def _install_signal_handlers(self):
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            self.loop.add_signal_handler(signum, self.stop, f"received {signal.Signals(signum).name}")
+
+    def run(self, until=None):
+        """ Run the loop until stop() is called, a signal arrives, or the given future completes """
+        self._install_signal_handlers()
+        if until is not None:
+            until.add_done_callback(lambda f: self.stop(f.result()))
+        try:
+            return self.loop.run_until_complete(self.stopping)
+        finally:
+            for connection in list(self.connections):
+                connection.close("shutting down")
+            for tun_fd in self.tun_fds:
+                self.loop.remove_reader(tun_fd)
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                self.loop.remove_signal_handler(signum)
+            self.loop.close()
+
+
+def start_async_forwarding(tun_fd, tls_socket, on_control=None, max_batch=32, mtu=DEFAULT_MTU, compressor=None):
+    """ asyncio counterpart of forwarder.start_forwarding for a single tunnel """
+    engine = AsyncEngine(max_batch, mtu=mtu)
+    connection = engine.add_tunnel(tun_fd, tls_socket, on_control, compressor)
+
+    Terminal.log("[*] Forwarding started (asyncio). Press Ctrl+C to exit.")
+    reason = engine.run(until=connection.closed)
+    Terminal.write(Terminal.get_color_bold(f"\n[!] Shutting down Diablo ({reason}).\n", "star"))
+    try:
+        tls_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    tls_socket.close()
+    os.close(tun_fd)
@@ -0,0 +1,210 @@
+"""
+Audit log of the server, on with "persistant_auditing" in config.json:
+connects, disconnects, failed handshakes, ARP conflicts and per-flow
+summaries. "aggressive_auditing" adds a record for every packet the port
+filter drops.
+
+Records are fixed size (RECORD, 64 bytes) and appended to segment files in
+~/.local/share/diablo/audit/<process>/, each starting with a SEGMENT_HEADER. A segment
+is closed once it reaches "audit_segment_mb" and the oldest are deleted
+beyond "audit_max_segments". Callers only append a tuple to a deque, the
+writer thread packs and writes whatever piled up every FLUSH_INTERVAL and
+fsyncs every FSYNC_INTERVAL, so a forwarding thread never waits on the disk.
+If the writer falls MAX_PENDING records behind new records are counted and
+dropped instead of growing memory.
+"""
+import os
+import time
+import struct
+import threading
+import ipaddress
+from collections import deque
+from .status import STATUS_FILE
+from .terminal import Terminal
+
+SEGMENT_HEADER = struct.Struct("!4sHH")         # magic, version, record size
+SEGMENT_MAGIC = b"DAUD"
+SEGMENT_VERSION = 1
+# time, kind, protocol, address a, address b, port a, port b, count a, count b
+RECORD = struct.Struct("!dBB2x16s16sHHQQ")
+
+CONNECT = 1         # a = tunnel address, b / port b = peer
+DISCONNECT = 2      # same as CONNECT, count a = seconds connected, count b = packets blocked
+AUTH_FAIL = 3       # b / port b = peer
+FILTER_HIT = 4      # a / port a = source, b / port b = destination
+ARP_CONFLICT = 5    # a = address, count a = previous MAC, count b = new MAC
+FLOW = 6            # a / port a = source, b / port b = destination, count a = bytes, count b = packets
+KINDS = {CONNECT: "connect", DISCONNECT: "disconnect", AUTH_FAIL: "auth_fail", FILTER_HIT: "filter_hit",
+         ARP_CONFLICT: "arp_conflict", FLOW: "flow"}
+
+AUDIT_DIR = STATUS_FILE.parent / "audit"
+DEFAULT_SEGMENT_MB = 16
+DEFAULT_MAX_SEGMENTS = 8
+FLUSH_INTERVAL = 1.0
+FLUSH_RECORDS = 4096        # wake the writer early once this many are waiting
+FSYNC_INTERVAL = 5.0
+MAX_PENDING = 64 * 1024
+
+IPV4_MAPPED = b"\0" * 10 + b"\xff\xff"
+
+def address(raw):
+    """ 16 byte form of an IPv4 or IPv6 address (packed or a string, IPv4 mapped), empty for None """
+    if not raw:
+        return b""
+    raw = ipaddress.ip_address(raw).packed if isinstance(raw, str) else bytes(raw)
+    return IPV4_MAPPED + raw if len(raw) == 4 else raw
+
+def read_segment(path):
+    """ Records of one segment file as dicts, for tools reading the audit log """
+    with open(path, "rb") as f:
+        magic, version, size = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or size != RECORD.size:
+            raise ValueError(f"{path} is not a Diablo audit segment")
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                return  # a torn last record after a crash is skipped
+            stamp, kind, protocol, a, b, port_a, port_b, count_a, count_b = RECORD.unpack(data)
+            yield {"time": stamp, "kind": KINDS.get(kind, kind), "protocol": protocol, "a": a, "b": b,
+                   "port_a": port_a, "port_b": port_b, "count_a": count_a, "count_b": count_b}
+
+
+class AuditWriter:
+    """ Segment files of one process and the thread writing them """
+
+    def __init__(self, directory, segment_bytes, max_segments):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max(1, max_segments)
+        self.pending = deque()
+        self.dropped = 0
+        self.written = 0
+        self.fd = None
+        self.size = 0
+        self.index = 0
+        self.wake = threading.Event()
+        self.stop = threading.Event()
+        self.thread = None
+
+    def append(self, record):
+        """ Called from any thread, never blocks """
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self.pending.append(record)
+        if len(self.pending) == FLUSH_RECORDS:
+            self.wake.set()
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith("segment-"))
+
+    def _open_segment(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+        self.index += 1
+        path = self.directory / f"segment-{self.index:06d}.bin"
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        os.write(self.fd, SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, RECORD.size))
+        self.size = SEGMENT_HEADER.size
+        for name in self._segments()[:-self.max_segments]:
+            os.remove(self.directory / name)
+
+    def start(self):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        segments = self._segments()
+        # Always start a new segment, a crash may have left half a record at the end of the last one
+        self.index = int(segments[-1][len("segment-"):-len(".bin")]) if segments else 0
+        self._open_segment()
+        self.thread = threading.Thread(target=self.run, name="audit_writer", daemon=True)
+        self.thread.start()
+
+    def _flush(self):
+        """ Pack and write everything pending, in as few writes as the segment size allows """
+        while self.pending:
+            room = max(1, (self.segment_bytes - self.size) // RECORD.size)
+            data = bytearray()
+            while self.pending and room:
+                data += RECORD.pack(*self.pending.popleft())
+                room -= 1
+            os.write(self.fd, data)
+            self.size += len(data)
+            self.written += len(data) // RECORD.size
+            if self.size >= self.segment_bytes:
+                self._open_segment()
+
+    def run(self):
+        synced = time.monotonic()
+        while True:
+            stopping = self.stop.is_set()
+            try:
+                self._flush()
+                if stopping or time.monotonic() - synced >= FSYNC_INTERVAL:
+                    os.fsync(self.fd)
+                    synced = time.monotonic()
+            except OSError as e:
+                Terminal.error(f"Audit log write failed, auditing stopped: {e}", exit=False)
+                return
+            if stopping:
+                os.close(self.fd)
+                return
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+
+    def close(self):
+        self.stop.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout=FSYNC_INTERVAL)
+
+    def stats(self):
+        return {"written": self.written, "pending": len(self.pending), "dropped": self.dropped,
+                "segment": self.index}
+
+
+class Audit:
+    """ Audit log of this process, every call is a no-op while auditing is off """
+    writer = None
+    aggressive = False
+
+    @staticmethod
+    def start(config, name="server"):
+        if Audit.writer is not None:
+            return
+        if not config.get("persistant_auditing", False) and not config.get("aggressive_auditing", False):
+            return
+        writer = AuditWriter(AUDIT_DIR / name,
+                             max(1, config.get("audit_segment_mb", DEFAULT_SEGMENT_MB)) * 1024 * 1024,
+                             config.get("audit_max_segments", DEFAULT_MAX_SEGMENTS))
+        try:
+            writer.start()
+        except OSError as e:
+            Terminal.warn(f"Could not open the audit log in {writer.directory}: {e}")
+            return
+        Audit.writer = writer
+        Audit.aggressive = config.get("aggressive_auditing", False)
+
+    @staticmethod
+    def stop():
+        writer, Audit.writer = Audit.writer, None
+        Audit.aggressive = False
+        if writer is not None:
+            writer.close()
+
+    @staticmethod
+    def record(kind, protocol=0, a=None, b=None, port_a=0, port_b=0, count_a=0, count_b=0):
+        writer = Audit.writer
+        if writer is not None:
+            writer.append((time.time(), kind, protocol, address(a), address(b), port_a, port_b, count_a, count_b))
+
+    @staticmethod
+    def filter_hit(packet, protocol, source, destination):
+        """ Aggressive auditing only, packet is the dropped IPv4 / IPv6 packet """
+        if packet[0] >> 4 == 4:
+            Audit.record(FILTER_HIT, protocol, packet[12:16], packet[16:20], source, destination)
+        else:
+            Audit.record(FILTER_HIT, protocol, packet[8:24], packet[24:40], source, destination)
+
+    @staticmethod
+    def stats():
+        return Audit.writer.stats() if Audit.writer is not None else None
@@ -1,6 +1,11 @@
 import os
 import sys
 import time
+import hmac
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import getpass
 import platform
 import ctypes
@@ -10,10 +15,21 @@ from argon2 import PasswordHasher
 from .settings import Settings
 from .terminal import Terminal 
 
+AUTH_TOKEN_TTL = 600
+
+def _verify_hash(hash, attempt):
+    """ argon2 check run inside the verify pool, module level so it can be pickled """
+    try:
+        return Authentication.ph.verify(hash, attempt)
+    except Exception:
+        return False
+
 class Authentication:
 
     CONFIG_KEY = "password_hash"
     ph = PasswordHasher()
+    token_key = os.urandom(32)  # per server process, resume tokens don't survive a restart
+    verify_pool = None
     root_name = "administrator" if platform.system() == "Windows" else "root"
 
     @staticmethod
@@ -32,13 +48,11 @@ class Authentication:
     
     @staticmethod
     def is_password_required():
-        config = Settings.load_config()
-        return config.get("require_password", False)
+        return Settings.get("require_password", False)
 
     @staticmethod
     def is_password_set():
-        config = Settings.load_config()
-        return bool(config.get(Authentication.CONFIG_KEY, "").strip())
+        return bool(Settings.get(Authentication.CONFIG_KEY, "").strip())
 
     @staticmethod
     def change_password(warn=False):
@@ -116,14 +130,56 @@ class Authentication:
         except KeyboardInterrupt:
             sys.exit(1)
 
+    @staticmethod
+    def start_verify_pool(processes):
+        """
+        From now on verify_password runs argon2 in a pool of worker processes,
+        so a burst of logins is bounded to that many cores and never competes
+        with the data plane for this process. Spawned rather than forked, the
+        server already runs threads.
+        """
+        if processes > 0 and Authentication.verify_pool is None:
+            Authentication.verify_pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+
+    @staticmethod
+    def stop_verify_pool():
+        if Authentication.verify_pool is not None:
+            Authentication.verify_pool.shutdown(wait=False, cancel_futures=True)
+            Authentication.verify_pool = None
+
     @staticmethod
     def verify_password(attempt: str) -> bool:
+        hash = Settings.get(Authentication.CONFIG_KEY, "")
+        if Authentication.verify_pool is not None:
+            try:
+                return Authentication.verify_pool.submit(_verify_hash, hash, attempt).result()
+            except BrokenProcessPool:
+                Terminal.warn("Password verification pool died, verifying in-process")
+                Authentication.verify_pool = None
+        return _verify_hash(hash, attempt)
+
+    @staticmethod
+    def _token_mac(client_id, expires):
+        return hmac.new(Authentication.token_key, f"{client_id}|{expires}".encode(), hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def issue_token(client_id, ttl=AUTH_TOKEN_TTL):
+        """ Short-lived token for client_id, a reconnect presenting it skips the argon2 password check """
+        expires = int(time.time()) + ttl
+        return f"{expires}.{Authentication._token_mac(client_id, expires)}"
+
+    @staticmethod
+    def verify_token(token, client_id) -> bool:
         try:
-            hash = Settings.load_config().get(Authentication.CONFIG_KEY, "")
-            Authentication.ph.verify(hash, attempt)
-            return True
-        except Exception:
+            expires, mac = token.split(".", 1)
+            expires = int(expires)
+        except (AttributeError, ValueError):
+            return False
+        if not mac.isascii():
+            return False  # compare_digest only takes ASCII strings
+        if expires < time.time():
             return False
+        return hmac.compare_digest(mac, Authentication._token_mac(client_id, expires))
         
     @staticmethod
     def setup_password():
@@ -0,0 +1,64 @@
+from collections import deque
+
+BUFFER_SIZE = 16 * 1024     # one full TLS record
+MAX_BUFFERS = 1024          # 16 MiB ceiling for everything queued towards clients
+
+class Buffer:
+    """ Preallocated bytearray plus a memoryview over it, filled at end and drained from start """
+
+    __slots__ = ("data", "view", "start", "end")
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+
+    @property
+    def room(self):
+        return len(self.data) - self.end
+
+    @property
+    def pending(self):
+        return self.end - self.start
+
+    def append(self, chunk):
+        """ Copy chunk (bytes or memoryview) in place, no new objects are allocated """
+        length = len(chunk)
+        self.view[self.end:self.end + length] = chunk
+        self.end += length
+
+
+class BufferRing:
+    """
+    Pool of reusable buffers for data that has to outlive a single read, like
+    frames queued for a client's writer. Buffers are created on demand up to
+    max_buffers and recycled after that, so once traffic has warmed the pool up
+    the forwarding loops stop allocating. When the pool is exhausted acquire()
+    returns None and the caller drops the data, which caps memory for the
+    whole server. deque append / popleft are thread safe, no lock needed.
+    """
+
+    def __init__(self, size=BUFFER_SIZE, max_buffers=MAX_BUFFERS):
+        self.size = size
+        self.max_buffers = max_buffers
+        self.allocated = 0
+        self.free = deque()
+
+    def acquire(self):
+        try:
+            return self.free.popleft()
+        except IndexError:
+            pass
+        if self.allocated >= self.max_buffers:
+            return None
+        self.allocated += 1
+        return Buffer(self.size)
+
+    def release(self, buffer):
+        buffer.start = buffer.end = 0
+        self.free.append(buffer)
+
+    @property
+    def in_use(self):
+        return self.allocated - len(self.free)
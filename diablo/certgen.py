@@ -5,28 +5,69 @@ from pathlib import Path
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 from .terminal import Terminal
+from .settings import Settings
 
-def generate_self_signed_cert(cert_path="certs/cert.pem", key_path="certs/key.pem"):
+CERT_PATH = Settings.CERTS_DIR / "cert.pem"
+KEY_PATH = Settings.CERTS_DIR / "key.pem"
+DEFAULT_KEY_TYPE = "ecdsa-p256"
+DEFAULT_ROTATION_DAYS = 90
+
+def _new_key(key_type):
+    """ P-256 and Ed25519 signatures are an order of magnitude cheaper than RSA for the server's handshakes """
+    if key_type == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    if key_type == "rsa-2048":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return ec.generate_private_key(ec.SECP256R1())
+
+def _key_type(public_key):
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return "ed25519"
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return "rsa-2048"
+    return "ecdsa-p256"
+
+def _needs_rotation(cert_path, key_type, rotation_days):
+    """ Reason to replace the existing certificate, None if it is still good """
+    try:
+        with open(cert_path, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+    except (OSError, ValueError):
+        return "certificate can't be read"
+    if _key_type(cert.public_key()) != key_type:
+        return f"key type changed to {key_type}"
+    expires = cert.not_valid_after_utc.replace(tzinfo=None) if hasattr(cert, "not_valid_after_utc") \
+        else cert.not_valid_after
+    if expires - datetime.datetime.utcnow() < datetime.timedelta(days=max(1, rotation_days // 10)):
+        return "certificate is about to expire"
+    return None
+
+def generate_self_signed_cert(cert_path=CERT_PATH, key_path=KEY_PATH):
     """
     Generates a self-signed TLS certificate and key pair.
-    Saves them to the certs/ directory.
+    Saves them to Settings.CERTS_DIR. The key type comes from cert_key_type,
+    and the pair is replaced once less than a tenth of its cert_rotation_days
+    validity is left or the configured key type changes.
     """
-    if os.path.exists(cert_path) and os.path.exists(key_path):
-        Terminal.proceed("Certificate exists")
-        return
+    key_type = Settings.get("cert_key_type", DEFAULT_KEY_TYPE)
+    rotation_days = max(1, Settings.get("cert_rotation_days", DEFAULT_ROTATION_DAYS))
 
-    Terminal.warn(dedent("""No certificate found. If this was removed by accident, please update certs/cert.pem. 
-                            Otherwise, if this is your first time hosting, this warning can be safely ignored. 
-                            
-                            Proceeding to create new self-signed certificate key pair..."""))
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        reason = _needs_rotation(cert_path, key_type, rotation_days)
+        if reason is None:
+            Terminal.proceed("Certificate exists")
+            return
+        Terminal.warn(f"Rotating TLS certificate: {reason}")
+    else:
+        Terminal.warn(dedent(f"""No certificate found. If this was removed by accident, please update {cert_path}. 
+                                Otherwise, if this is your first time hosting, this warning can be safely ignored. 
+                                
+                                Proceeding to create new self-signed certificate key pair..."""))
 
     # Generate private key
-    key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-    )
+    key = _new_key(key_type)
 
     # Certificate subject and issuer
     subject = x509.Name([
@@ -45,31 +86,36 @@ def generate_self_signed_cert(cert_path="certs/cert.pem", key_path="certs/key.pe
         .public_key(key.public_key())
         .serial_number(x509.random_serial_number())
         .not_valid_before(datetime.datetime.utcnow() - datetime.timedelta(days=1))
-        .not_valid_after(datetime.datetime.utcnow() + datetime.timedelta(days=365))
+        .not_valid_after(datetime.datetime.utcnow() + datetime.timedelta(days=rotation_days))
         .add_extension(
             x509.SubjectAlternativeName([x509.DNSName(u"localhost")]),
             critical=False,
         )
-        .sign(key, hashes.SHA256())
+        .sign(key, None if key_type == "ed25519" else hashes.SHA256())  # Ed25519 hashes internally
     )
 
-    # Ensure certs/ folder exists
-    Path("certs").mkdir(exist_ok=True)
+    # Ensure the certs folder exists
+    Path(key_path).parent.mkdir(parents=True, exist_ok=True)
 
-    # Write key to file
-    with open(key_path, "wb") as f:
+    # Write key to file, PKCS8 is the only format that covers every key type. Written to a temp file and
+    # renamed so an existing key.pem with looser permissions is replaced, not rewritten in place
+    tmp_path = f"{key_path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # the mode above only applies if the temp file is new
+    with os.fdopen(fd, "wb") as f:
         f.write(
             key.private_bytes(
                 encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
+                format=serialization.PrivateFormat.PKCS8,
                 encryption_algorithm=serialization.NoEncryption()
             )
         )
+    os.replace(tmp_path, key_path)
 
     # Write cert to file
     with open(cert_path, "wb") as f:
         f.write(cert.public_bytes(serialization.Encoding.PEM))
 
-    Terminal.success("TLS certificate and key generated.")
+    Terminal.success(f"TLS certificate and {key_type} key generated.")
     Terminal.print(f"\tCertificate in ({cert_path})", bold=True)
     Terminal.print(f"\tKey in ({key_path})", bold=True)
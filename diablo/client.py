@@ -1,15 +1,306 @@
-from .tun import setup_tun_interface
-#from .tls_handler import start_tls_client
-from .forwarder import start_forwarding
-from .terminal import Terminal 
-from .daemon import daemonize
-
-def start_client():
-    Terminal.print_intro()
-    Terminal.connecting_animation()
-
-    """
-    tun = setup_tun_interface("10.8.0.2", "255.255.255.0")
-    conn = start_tls_client(args.server_ip)
-    start_forwarding(tun, conn)
-    """
\ No newline at end of file
+import os
+import ssl
+import uuid
+import random
+import socket
+import getpass
+import platform
+import threading
+
+from .tun import setup_tun_interface, configure_tun_linux, clamp_mtu, DEFAULT_MTU
+from .tls_handler import start_tls_client, client_hello, SessionStore, CONFIG_DIR
+from .handshake import HandshakeError
+from .forwarder import start_worker, wait_for_shutdown, forwarding_options, tun_to_socket, socket_to_tun
+from .protocol import encode_frame, FRAME_CONTROL
+from .compression import supported_methods, make_compressor
+from .ping import Pinger, PING_INTERVAL, PING_TICK, DEAD_PEER_PINGS
+from .arp import ArpProtection
+from .settings import Settings
+from .terminal import Terminal
+from .status import Status
+
+SERVER_PORT = 4433
+CLIENT_TUN = "diablo0"
+CLIENT_ID_FILE = CONFIG_DIR / "client_id"
+
+RECONNECT_BASE = 1
+RECONNECT_MAX_DELAY = 60
+
+# Rejections that come back the same no matter how often we retry
+FATAL_REASONS = ("invalid password", "unsupported protocol version")
+
+def backoff_delay(attempt, base=RECONNECT_BASE, cap=RECONNECT_MAX_DELAY):
+    """ Exponential backoff with full jitter, anywhere between 0 and min(cap, base * 2**attempt) seconds """
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 16)))
+
+def client_id():
+    """ Random id kept in the config dir, so the server hands us the same tunnel address on every reconnect """
+    try:
+        return CLIENT_ID_FILE.read_text().strip()
+    except FileNotFoundError:
+        pass
+    identity = uuid.uuid4().hex
+    os.makedirs(CLIENT_ID_FILE.parent, exist_ok=True)
+    CLIENT_ID_FILE.write_text(identity)
+    return identity
+
+def stopped_by_user(reason):
+    """ Forwarding ended because of Ctrl+C or a signal ('diablo disconnect'), not because the connection died """
+    return reason == "interrupted" or reason.startswith("received SIG")
+
+
+class LockedSocket:
+    """ TLS socket shared by the TUN reader, the TLS reader (pongs) and the ping thread, writes never interleave """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def sendall(self, data):
+        with self.lock:
+            self.conn.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class Client:
+    mode = "client"
+    pid = os.getpid()
+    server = None
+    port = SERVER_PORT
+    password = None
+    tun_fd = None
+    address = None      # (ip, netmask, mtu) the TUN device is configured with
+    state = "connecting"
+    reconnects = 0
+    arp = None          # ArpProtection of the interface the server is reached through
+
+    @staticmethod
+    def _check_if_root():
+        if not Status.is_root():
+            Terminal.error("You must run as root / administrator to connect to a Diablo server")
+
+    @staticmethod
+    def save_status():
+        """ Publish the connection state for 'diablo status' """
+        Status.save_status({
+            "mode": Client.mode,
+            "pid": Client.pid,
+            "server": f"{Client.server}:{Client.port}",
+            "state": Client.state,
+            "tunnel_ip": Client.address[0] if Client.address else None,
+            "reconnects": Client.reconnects,
+            "arp": Client.arp.stats() if Client.arp is not None else None,
+        })
+
+    @staticmethod
+    def start_client(server_ip, port=SERVER_PORT):
+        """
+        Connect to a Diablo server and forward until Ctrl+C or 'diablo disconnect'.
+        Whenever the connection drops it is re-established with exponential
+        backoff and full jitter; the TUN device stays up in between, so
+        applications only see a stall instead of the interface going away.
+        """
+        Terminal.print_intro()
+        Client._check_if_root()
+        active, _ = Status.is_session_active()
+        if active:
+            Terminal.error("A Diablo session is already running, see 'diablo status'")
+
+        config = Settings.values()
+        Client.server, Client.port = server_ip, port
+        hello = {
+            "name": config.get("name", ""),
+            "client_id": client_id(),
+            "mtu": clamp_mtu(config.get("tunnel_mtu", DEFAULT_MTU)),
+            "compression": list(supported_methods(config.get("compression", "off"))),
+        }
+        Client.arp = ArpProtection(config, peer=server_ip)
+        Client.arp.apply()
+        arp_stop = threading.Event()
+        Client.arp.start_watching(arp_stop)
+        Client.save_status()
+        try:
+            reason = Client._run(SessionStore(), hello, config)
+        except KeyboardInterrupt:
+            reason = "interrupted"
+        finally:
+            arp_stop.set()
+            Client.arp.remove()
+            if Client.tun_fd is not None:
+                os.close(Client.tun_fd)
+            Status.clear_status()
+        Terminal.write(Terminal.get_color_bold(f"\n[!] Disconnected from Diablo ({reason}).\n", "star"))
+
+    @staticmethod
+    def _run(store, hello, config):
+        """ Connect, forward, repeat until stopped by the user. Returns the reason """
+        attempt = 0
+        while True:
+            Terminal.log(f"Connecting to {Client.server}:{Client.port}")
+            try:
+                conn, reply = Client._connect(store, hello)
+            except (OSError, ssl.SSLError, HandshakeError) as e:
+                Terminal.warn(f"Could not connect to {Client.server}: {e}")
+            else:
+                attempt = 0
+                reason = Client._forward(conn, reply, config)
+                if stopped_by_user(reason):
+                    return reason
+                Terminal.warn(f"Connection to {Client.server} lost ({reason})")
+
+            Client.state = "reconnecting"
+            Client.save_status()
+            delay = backoff_delay(attempt, cap=max(RECONNECT_BASE, config.get("reconnect_max_delay",
+                                                                               RECONNECT_MAX_DELAY)))
+            attempt += 1
+            Client.reconnects += 1
+            Terminal.log(f"Reconnecting in {delay:.1f}s (attempt {attempt})")
+            reason = Client._sleep(delay)
+            if reason is not None:
+                return reason
+
+    @staticmethod
+    def _sleep(delay):
+        """ Wait out a backoff delay, None when it passed, the reason if Ctrl+C or a signal cut it short """
+        done = threading.Event()
+        timer = threading.Timer(delay, done.set)
+        timer.daemon = True
+        timer.start()
+        reason = wait_for_shutdown(done, reason=None)
+        timer.cancel()
+        return reason
+
+    @staticmethod
+    def _connect(store, hello):
+        """
+        TLS connection plus handshake, returns (conn, reply). The password is
+        only asked for when the server wants one and no resume token worked.
+        Rejections worth retrying raise HandshakeError, the rest exit.
+        """
+        server = f"{Client.server}:{Client.port}"
+        while True:
+            conn = start_tls_client(Client.server, Client.port, store)
+            try:
+                reply = client_hello(conn, store, server, hello, Client.password)
+            except BaseException:
+                conn.close()
+                raise
+            if reply.get("auth") == "ok":
+                return conn, reply
+            conn.close()
+            reason = reply.get("reason", "connection refused")
+            if reason in ("invalid password", "invalid or expired resume token") and Client.password is None:
+                Client.password = getpass.getpass(Terminal.get_bold(f"Password for {Client.server}: "))
+                continue
+            if reason.startswith(FATAL_REASONS):
+                Status.clear_status()
+                Terminal.error(f"Server refused the connection: {reason}")
+            raise HandshakeError(reason)
+
+    @staticmethod
+    def _ensure_tun(ip, netmask, mtu):
+        """ Bring the TUN device up on the first connect, afterwards only reconfigure it if the server changed it """
+        address = (ip, netmask, mtu)
+        if Client.tun_fd is None:
+            Client.tun_fd = setup_tun_interface(ip, netmask, CLIENT_TUN, mtu)
+        elif address != Client.address:
+            if platform.system() == "Linux":
+                configure_tun_linux(ip, netmask, CLIENT_TUN, mtu)
+            else:
+                Terminal.warn(f"Server assigned {ip} (mtu {mtu}), reconnect with 'diablo restart' to apply it")
+                return
+        Client.address = address
+
+    @staticmethod
+    def _forward(conn, reply, config):
+        """ Forward over one connection until it dies or the user stops us, returns the reason """
+        mtu = clamp_mtu(reply.get("mtu", DEFAULT_MTU))
+        Client._ensure_tun(reply["ip"], reply["netmask"], mtu)
+        compressor = make_compressor(reply.get("compression"), mtu)
+        pinger = Pinger(config.get("keepalive_interval", PING_INTERVAL), config.get("dead_peer_pings", DEAD_PEER_PINGS))
+
+        Client.state = "connected"
+        Client.save_status()
+        Terminal.success(f"Connected to {Client.server} as {reply['ip']} (mtu {mtu}, "
+                         f"compression {reply.get('compression', 'none')})")
+        try:
+            if config.get("data_plane", "threads") == "asyncio":
+                reason = Client._forward_asyncio(conn, mtu, compressor, pinger, config)
+            else:
+                reason = Client._forward_threads(conn, mtu, compressor, pinger, config)
+        finally:
+            conn.close()
+        return "server stopped answering pings" if pinger.dead else reason
+
+    @staticmethod
+    def _ping_loop(pinger, send, stop):
+        """ Threads engine, returns (stopping the other workers through start_worker) once the server is dead """
+        while not stop.wait(PING_TICK):
+            payload = pinger.poll()
+            if pinger.dead:
+                return
+            if payload is not None:
+                try:
+                    send(encode_frame(FRAME_CONTROL, payload))
+                except OSError:
+                    return
+
+    @staticmethod
+    def _forward_threads(conn, mtu, compressor, pinger, config):
+        max_batch, flush_ms = forwarding_options(config)
+        shared = LockedSocket(conn)
+
+        def on_control(payload):
+            reply = pinger.on_control(payload)
+            if reply is not None:
+                shared.sendall(encode_frame(FRAME_CONTROL, reply))
+
+        stop = threading.Event()
+        wake_r, wake_w = os.pipe()
+        workers = [
+            start_worker(tun_to_socket, (Client.tun_fd, shared, max_batch, flush_ms, mtu, stop, wake_r, compressor),
+                         stop),
+            start_worker(socket_to_tun, (conn, Client.tun_fd, on_control, mtu, stop, compressor), stop),
+            start_worker(Client._ping_loop, (pinger, shared.sendall, stop), stop),
+        ]
+        reason = wait_for_shutdown(stop)
+        os.write(wake_w, b"\0")
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        for worker in workers:
+            worker.join(timeout=1)
+        os.close(wake_r)
+        os.close(wake_w)
+        return reason
+
+    @staticmethod
+    def _forward_asyncio(conn, mtu, compressor, pinger, config):
+        from .async_forwarder import AsyncEngine
+        max_batch, _ = forwarding_options(config)
+        engine = AsyncEngine(max_batch, mtu=mtu)
+
+        def on_control(payload):
+            reply = pinger.on_control(payload)
+            if reply is not None:
+                connection.send_control(reply)
+
+        def tick():
+            payload = pinger.poll()
+            if pinger.dead:
+                engine.stop("server stopped answering pings")
+                return
+            if payload is not None:
+                connection.send_control(payload)
+            engine.loop.call_later(PING_TICK, tick)
+
+        connection = engine.add_tunnel(Client.tun_fd, conn, on_control, compressor)
+        engine.loop.call_later(PING_TICK, tick)
+        return engine.run(until=connection.closed)
+
+
+def start_client(server_ip="127.0.0.1", port=SERVER_PORT):
+    Client.start_client(server_ip, port)
@@ -0,0 +1,159 @@
+"""
+Optional compression of tunnel packets, set with "compression" in
+config.json and negotiated per client in the handshake. Every packet is
+compressed on its own (frames can be dropped on the way to a congested
+client, so there is no shared stream state) and sent as a COMPRESSED frame;
+packets that don't shrink go out as plain DATA frames. zlib (raw deflate,
+level 1) is always available, LZ4 needs the optional lz4 package
+(pip install diablo[lz4]).
+"""
+import time
+import zlib
+import struct
+from .protocol import FRAME_COMPRESSED, FrameError, encode_frame
+from .terminal import Terminal
+
+try:
+    import lz4.block
+    HAS_LZ4 = True
+    DECOMPRESS_ERRORS = (zlib.error, ValueError, lz4.block.LZ4BlockError)
+except ImportError:
+    HAS_LZ4 = False
+    DECOMPRESS_ERRORS = (zlib.error, ValueError)
+
+COMPRESSION_NONE = "none"
+MIN_PACKET = 128        # ACKs, DNS and other small packets aren't worth the CPU
+MIN_SAVING = 32         # below this a COMPRESSED frame isn't worth decompressing
+MAX_BACKOFF = 6         # after repeated misses skip up to 2**6 packets of the flow before trying again
+FLOW_SLOTS = 256        # backoff is kept per flow hash, collisions only share a backoff
+ZLIB_LEVEL = 1
+ZLIB_WBITS = -15        # raw deflate, no header or checksum, TLS already protects the data
+
+# Ports whose traffic is already encrypted or compressed, never worth a try
+ENCRYPTED_PORTS = frozenset({22, 443, 465, 853, 993, 995, 1194, 4433, 51820})
+IP_TCP = 6
+IP_UDP = 17
+IPV4_FLOW = struct.Struct("!9xB2xII")  # protocol, source, destination
+PORTS = struct.Struct("!HH")
+
+def supported_methods(setting):
+    """ Methods the local end accepts for a "compression" setting, best first, always ending in "none" """
+    if setting == "lz4":
+        if HAS_LZ4:
+            return ("lz4", "zlib", COMPRESSION_NONE)
+        Terminal.warn("Compression is set to lz4 but the lz4 package isn't installed (pip install lz4), using zlib")
+    if setting in ("lz4", "zlib"):
+        return ("zlib", COMPRESSION_NONE)
+    return (COMPRESSION_NONE,)
+
+def encrypted_port(packet):
+    """ True for TCP / UDP IPv4 packets to or from one of ENCRYPTED_PORTS """
+    if packet[0] >> 4 != 4 or packet[9] not in (IP_TCP, IP_UDP):
+        return False
+    offset = (packet[0] & 0x0F) * 4
+    if len(packet) < offset + 4:
+        return False
+    source = packet[offset] << 8 | packet[offset + 1]
+    destination = packet[offset + 2] << 8 | packet[offset + 3]
+    return source in ENCRYPTED_PORTS or destination in ENCRYPTED_PORTS
+
+def flow_slot(packet):
+    """ FLOW_SLOTS bucket of the connection (addresses, protocol, ports) a packet belongs to """
+    if packet[0] >> 4 == 4 and len(packet) >= 20:
+        protocol, source, destination = IPV4_FLOW.unpack_from(packet)
+        offset = (packet[0] & 0x0F) * 4
+    elif len(packet) >= 40:
+        protocol, source, destination = packet[6], bytes(packet[8:24]), bytes(packet[24:40])
+        offset = 40
+    else:
+        return 0
+    ports = PORTS.unpack_from(packet, offset) if protocol in (IP_TCP, IP_UDP) and len(packet) >= offset + 4 else ()
+    return hash((protocol, source, destination, *ports)) & (FLOW_SLOTS - 1)
+
+
+class Compressor:
+    """
+    Compression for one tunnel in both directions. Packets that are small or
+    on an encrypted port are bypassed without being looked at. Every packet
+    that doesn't shrink doubles the number of packets of its flow skipped
+    before the next attempt (up to 2**MAX_BACKOFF), a packet that does resets
+    it, so a run of HTTPS or video costs a few failed attempts instead of one
+    per packet while compressible flows next to it keep being compressed.
+    Counters feed 'diablo status'.
+    """
+
+    __slots__ = ("method", "mtu", "misses", "skip", "compressed", "bypassed", "bytes_in", "bytes_out", "cpu_time")
+
+    def __init__(self, method, mtu):
+        if method not in ("zlib", "lz4") or (method == "lz4" and not HAS_LZ4):
+            raise ValueError(f"Unsupported compression method {method}")
+        self.method = method
+        self.mtu = mtu
+        self.misses = bytearray(FLOW_SLOTS)     # per flow slot, consecutive packets that didn't shrink
+        self.skip = bytearray(FLOW_SLOTS)       # per flow slot, packets left to bypass
+        self.compressed = 0
+        self.bypassed = 0
+        self.bytes_in = 0       # original size of every packet sent compressed
+        self.bytes_out = 0      # their size on the wire
+        self.cpu_time = 0.0
+
+    def _compress(self, packet):
+        if self.method == "lz4":
+            return lz4.block.compress(packet, store_size=False)
+        return zlib.compress(packet, ZLIB_LEVEL, ZLIB_WBITS)
+
+    def frame(self, packet):
+        """ COMPRESSED frame for packet, or None if it should go out as a plain DATA frame """
+        if len(packet) < MIN_PACKET or encrypted_port(packet):
+            self.bypassed += 1
+            return None
+        slot = flow_slot(packet)
+        if self.skip[slot]:
+            self.skip[slot] -= 1
+            self.bypassed += 1
+            return None
+        started = time.thread_time()
+        data = self._compress(packet)
+        self.cpu_time += time.thread_time() - started
+        if len(data) > len(packet) - MIN_SAVING:
+            misses = self.misses[slot] = min(self.misses[slot] + 1, MAX_BACKOFF)
+            self.skip[slot] = (1 << misses) - 1
+            self.bypassed += 1
+            return None
+        self.misses[slot] = 0
+        self.compressed += 1
+        self.bytes_in += len(packet)
+        self.bytes_out += len(data)
+        return encode_frame(FRAME_COMPRESSED, data)
+
+    def decompress(self, payload):
+        """ Original packet of a COMPRESSED frame, FrameError if it is corrupt or larger than the MTU """
+        started = time.thread_time()
+        try:
+            if self.method == "lz4":
+                packet = lz4.block.decompress(payload, uncompressed_size=self.mtu)
+            else:
+                inflater = zlib.decompressobj(ZLIB_WBITS)
+                packet = inflater.decompress(payload, self.mtu)
+                if inflater.unconsumed_tail or not inflater.eof:
+                    raise FrameError(f"Compressed packet is truncated or larger than the MTU of {self.mtu}")
+        except DECOMPRESS_ERRORS as e:
+            raise FrameError(f"Corrupt compressed packet: {e}")
+        finally:
+            self.cpu_time += time.thread_time() - started
+        return packet
+
+    def stats(self):
+        return {
+            "method": self.method,
+            "compressed": self.compressed,
+            "bypassed": self.bypassed,
+            "saved_bytes": self.bytes_in - self.bytes_out,
+            "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+            "cpu_ms": round(self.cpu_time * 1000, 1),
+        }
+
+
+def make_compressor(method, mtu):
+    """ Compressor for the method the handshake settled on, None for "none" """
+    return None if method in (None, COMPRESSION_NONE) else Compressor(method, mtu)
@@ -0,0 +1,185 @@
+"""
+Kernel side filtering with nftables. The server's "blocked_ports",
+"filtered_ports" and "lockdown_mode" are turned into a table of its own
+(inet diablo) hooked to the TUN interface from "bind_interface":
+
+    from_clients    traffic the clients send, to the server or through it
+    to_clients      traffic on its way to a client, where filtered_ports also apply
+    lockdown_*      filled while lockdown_mode is on, clients may only talk to
+                    addresses inside the tunnel subnet
+
+The ports live in nftables sets, so a packet costs the kernel one hash
+lookup and blocked traffic never reaches Diablo. The table is loaded in one
+'nft -f' transaction (nothing is half applied), later config changes (the
+settings menu writes config.json, see Settings._refresh) only add or delete
+the set elements and lockdown rules that changed. Without nft the same
+rules are enforced in process by packet_filter.PacketFilter.
+"""
+import mmap
+import shutil
+import subprocess
+import threading
+from .settings import Settings
+from .terminal import Terminal
+
+TABLE = "inet diablo"
+PORT_SETS = ("blocked_ports", "filtered_ports")
+RECONCILE_INTERVAL = 1.0
+L4 = "meta l4proto { tcp, udp }"
+
+def _ports(config, key):
+    return {port for port in config.get(key) or () if isinstance(port, int) and 0 <= port <= 65535}
+
+def _elements(ports):
+    return "{ " + ", ".join(str(port) for port in sorted(ports)) + " }"
+
+def nft_available():
+    return shutil.which("nft") is not None
+
+def load_rules(lines):
+    """ Run lines as one nft transaction, the kernel applies all of them or none """
+    result = subprocess.run(["nft", "-f", "-"], input="\n".join(lines) + "\n", text=True, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f"nft exited with {result.returncode}")
+
+def delete_table(table):
+    subprocess.run(["nft", "delete", "table", *table.split()], check=False, stderr=subprocess.DEVNULL)
+
+
+class Firewall:
+    """
+    The nftables table of one server. apply() loads it, watch() keeps it in
+    step with config.json and remove() deletes it on shutdown. active is
+    False when nft is missing or refused the table, the caller falls back to
+    filtering in process. It is kept in a shared mapping, so multi-queue
+    workers forked after apply() see the main process fall back too.
+    """
+
+    def __init__(self, interface, network):
+        self.interface = interface
+        self.network = network
+        self._active = mmap.mmap(-1, 1)
+        self.applied = None     # {"blocked_ports": set, "filtered_ports": set, "lockdown": bool} in the kernel
+        self.config = None
+
+    @property
+    def active(self):
+        return self._active[0] == 1
+
+    @active.setter
+    def active(self, value):
+        self._active[0] = 1 if value else 0
+
+    def _wanted(self, config):
+        wanted = {key: _ports(config, key) for key in PORT_SETS}
+        wanted["lockdown"] = bool(config.get("lockdown_mode", False))
+        return wanted
+
+    def _lockdown_rules(self, lockdown, flush=True):
+        """ Commands that (re)fill the lockdown chains """
+        commands = [f"flush chain {TABLE} lockdown_from", f"flush chain {TABLE} lockdown_to"] if flush else []
+        if lockdown:
+            commands += [
+                f"add rule {TABLE} lockdown_from ip daddr != {self.network} counter drop",
+                f"add rule {TABLE} lockdown_from meta nfproto ipv6 counter drop",
+                f"add rule {TABLE} lockdown_to ip saddr != {self.network} counter drop",
+                f"add rule {TABLE} lockdown_to meta nfproto ipv6 counter drop",
+            ]
+        return commands
+
+    def _ruleset(self, wanted):
+        """ Whole table, replacing any left over from an earlier run in the same transaction """
+        interface = f'"{self.interface}"'
+        sets = []
+        for key in PORT_SETS:
+            elements = f" elements = {_elements(wanted[key])};" if wanted[key] else ""
+            sets.append(f"    set {key} {{ type inet_service;{elements} }}")
+        # Chains are declared before the chains that jump to them
+        lines = [
+            f"add table {TABLE}",
+            f"delete table {TABLE}",
+            f"table {TABLE} {{",
+            *sets,
+            "    chain lockdown_from { }",
+            "    chain lockdown_to { }",
+            "    chain from_clients {",
+            f"        {L4} th dport @blocked_ports counter drop",
+            f"        {L4} th sport @blocked_ports counter drop",
+            "        jump lockdown_from }",
+            "    chain to_clients {",
+            f"        {L4} th dport @blocked_ports counter drop",
+            f"        {L4} th sport @blocked_ports counter drop",
+            f"        {L4} th dport @filtered_ports counter drop",
+            "        jump lockdown_to }",
+            "    chain input { type filter hook input priority 0; policy accept;",
+            f"        iifname {interface} jump from_clients }}",
+            "    chain forward { type filter hook forward priority 0; policy accept;",
+            f"        iifname {interface} jump from_clients",
+            f"        oifname {interface} jump to_clients }}",
+            "    chain output { type filter hook output priority 0; policy accept;",
+            f"        oifname {interface} jump to_clients }}",
+            "}",
+        ]
+        return lines + self._lockdown_rules(wanted["lockdown"], flush=False)
+
+    def apply(self, config=None):
+        """ Load the whole table, True if the kernel is filtering from now on """
+        config = config if config is not None else Settings.values()
+        if not nft_available():
+            Terminal.warn("nft not found, blocked ports and lockdown mode are enforced by Diablo instead")
+            return False
+        wanted = self._wanted(config)
+        try:
+            load_rules(self._ruleset(wanted))
+        except (OSError, RuntimeError) as e:
+            Terminal.warn(f"Could not load the nftables rules, filtering in Diablo instead: {e}")
+            return False
+        self.applied, self.config, self.active = wanted, config, True
+        Terminal.log(f"nftables rules loaded on {self.interface}")
+        return True
+
+    def reconcile(self, config=None):
+        """ Bring the kernel up to date with config, touching only what changed """
+        config = config if config is not None else Settings.values()
+        if not self.active or config is self.config:
+            return
+        wanted = self._wanted(config)
+        commands = []
+        for key in PORT_SETS:
+            removed = self.applied[key] - wanted[key]
+            added = wanted[key] - self.applied[key]
+            if removed:
+                commands.append(f"delete element {TABLE} {key} {_elements(removed)}")
+            if added:
+                commands.append(f"add element {TABLE} {key} {_elements(added)}")
+        if wanted["lockdown"] != self.applied["lockdown"]:
+            commands += self._lockdown_rules(wanted["lockdown"])
+        self.config = config
+        if not commands:
+            return
+        try:
+            load_rules(commands)
+        except (OSError, RuntimeError) as e:
+            # Someone changed the table under us, start over from scratch
+            Terminal.warn(f"Updating the nftables rules failed ({e}), reloading them")
+            self.active = self.apply(config)
+            if not self.active:
+                delete_table(TABLE)  # don't leave stale rules enforcing the old config
+            return
+        self.applied = wanted
+        Terminal.log(f"nftables rules updated ({len(commands)} changes)")
+
+    def watch(self, stop):
+        """ Thread, reconciles whenever the Settings cache picks up a new config.json """
+        while not stop.wait(RECONCILE_INTERVAL):
+            self.reconcile()
+
+    def start_watching(self, stop):
+        if self.active:
+            threading.Thread(target=self.watch, args=(stop,), daemon=True).start()
+
+    def remove(self):
+        if not self.active:
+            return
+        self.active = False
+        delete_table(TABLE)
@@ -0,0 +1,208 @@
+"""
+Flow table of the server, kept while "monitor_ports" is on. Every TCP / UDP
+packet forwarded to or from a client is counted against its connection,
+keyed by the 5-tuple seen from the client's side (protocol, client address,
+remote address, client port, remote port), so both directions land on the
+same Flow.
+
+Idle flows are expired with a timer wheel: a flow sits in the slot of the
+tick it could expire at, and only that slot is looked at when its tick comes
+up. Packets just move flow.last, a flow that was active since it was put in
+the slot is moved further along instead of expired, so the per-packet cost
+is a dict lookup and a few attribute writes whatever the number of flows.
+The top talkers (by bytes) are kept as they change, never by walking the
+table. At most "max_flows" flows are tracked, later ones are only counted.
+"""
+import time
+import struct
+import threading
+import ipaddress
+from .packet_filter import transport_ports
+from .audit import Audit, FLOW
+
+IPV4_ADDRESS = struct.Struct("!I")
+PROTOCOL_NAMES = {6: "tcp", 17: "udp"}
+
+DEFAULT_MAX_FLOWS = 16384
+DEFAULT_IDLE_TIMEOUT = 60
+TICK = 1.0
+WHEEL_SLOTS = 64
+TOP_TALKERS = 10
+
+def flow_key(packet, to_client):
+    """ Client side 5-tuple of a TCP / UDP packet, None for anything else """
+    ports = transport_ports(packet)
+    if ports is None:
+        return None
+    protocol, source_port, destination_port = ports
+    if packet[0] >> 4 == 4:
+        source = IPV4_ADDRESS.unpack_from(packet, 12)[0]
+        destination = IPV4_ADDRESS.unpack_from(packet, 16)[0]
+    else:
+        source, destination = bytes(packet[8:24]), bytes(packet[24:40])
+    if to_client:
+        return protocol, destination, source, destination_port, source_port
+    return protocol, source, destination, source_port, destination_port
+
+def _address(value):
+    return str(ipaddress.IPv4Address(value) if isinstance(value, int) else ipaddress.IPv6Address(value))
+
+
+class Flow:
+    __slots__ = ("key", "sent", "received", "packets", "first", "last", "top")
+
+    def __init__(self, key, now):
+        self.key = key
+        self.sent = 0           # bytes from the client
+        self.received = 0       # bytes to the client
+        self.packets = 0
+        self.first = now
+        self.last = now
+        self.top = False        # one of the top talkers
+
+    @property
+    def bytes(self):
+        return self.sent + self.received
+
+    def info(self):
+        protocol, client, remote, client_port, remote_port = self.key
+        return {
+            "protocol": PROTOCOL_NAMES.get(protocol, protocol),
+            "client": f"{_address(client)}:{client_port}",
+            "remote": f"{_address(remote)}:{remote_port}",
+            "sent": self.sent,
+            "received": self.received,
+            "packets": self.packets,
+            "seconds": int(self.last - self.first),
+        }
+
+
+class FlowTable:
+    """
+    Shared by every forwarding thread. count() takes no lock unless it
+    creates a flow or changes the top talkers, both rare next to packets.
+    Counters updated by two threads at once may lose an increment, they are
+    statistics. tick() is called every TICK seconds by run().
+    """
+
+    def __init__(self, max_flows=DEFAULT_MAX_FLOWS, idle_timeout=DEFAULT_IDLE_TIMEOUT, top=TOP_TALKERS):
+        self.max_flows = max_flows
+        self.idle_timeout = max(TICK, idle_timeout)
+        self.flows = {}
+        self.wheel = [[] for _ in range(WHEEL_SLOTS)]
+        self.tick_count = 0     # ticks since start, wheel slot = tick_count % WHEEL_SLOTS
+        self.top_size = top
+        self.top = []           # top talkers, unordered
+        self.top_floor = 0      # smallest byte count among them once there are top_size
+        self.untracked = 0      # packets of flows over max_flows
+        self.expired = 0
+        self._lock = threading.Lock()
+
+    def count(self, packet, to_client):
+        key = flow_key(packet, to_client)
+        if key is None:
+            return
+        flow = self.flows.get(key)
+        now = time.monotonic()
+        if flow is None:
+            flow = self._add(key, now)
+            if flow is None:
+                return
+        if to_client:
+            flow.received += len(packet)
+        else:
+            flow.sent += len(packet)
+        flow.packets += 1
+        flow.last = now
+        if not flow.top and flow.sent + flow.received > self.top_floor:
+            self._promote(flow)
+
+    def _add(self, key, now):
+        with self._lock:
+            flow = self.flows.get(key)
+            if flow is not None:
+                return flow
+            if len(self.flows) >= self.max_flows:
+                self.untracked += 1
+                return None
+            flow = self.flows[key] = Flow(key, now)
+            self._schedule(flow, now)
+        return flow
+
+    def _schedule(self, flow, now):
+        """ Put flow in the slot of the tick it goes idle at, or the furthest one. Caller holds the lock """
+        ticks = int((flow.last + self.idle_timeout - now) / TICK) + 1
+        self.wheel[(self.tick_count + min(max(1, ticks), WHEEL_SLOTS - 1)) % WHEEL_SLOTS].append(flow)
+
+    def _promote(self, flow):
+        """ flow has more bytes than the smallest top talker, swap them """
+        with self._lock:
+            if flow.top or flow.key not in self.flows:
+                return
+            if len(self.top) >= self.top_size:
+                smallest = min(self.top, key=lambda top: top.bytes)
+                if smallest.bytes >= flow.bytes:
+                    self.top_floor = smallest.bytes  # the top talkers grew since the floor was set
+                    return
+                smallest.top = False
+                self.top.remove(smallest)
+            flow.top = True
+            self.top.append(flow)
+            if len(self.top) >= self.top_size:
+                self.top_floor = min(top.bytes for top in self.top)
+
+    def tick(self, now=None):
+        """ Expire the flows of the current slot that have been idle for idle_timeout """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.tick_count += 1
+            index = self.tick_count % WHEEL_SLOTS
+            slot, self.wheel[index] = self.wheel[index], []
+            for flow in slot:
+                if now - flow.last < self.idle_timeout:
+                    self._schedule(flow, now)
+                    continue
+                del self.flows[flow.key]
+                self.expired += 1
+                if flow.top:
+                    flow.top = False
+                    self.top.remove(flow)
+                    self.top_floor = 0  # refilled by the next flows promoted
+                if Audit.writer is not None:
+                    protocol, client, remote, client_port, remote_port = flow.key
+                    Audit.record(FLOW, protocol, _packed(client), _packed(remote), client_port, remote_port,
+                                 flow.bytes, flow.packets)
+
+    def run(self, stop):
+        """ Thread, ticks the wheel until stop is set """
+        while not stop.wait(TICK):
+            self.tick()
+
+    def top_talkers(self):
+        with self._lock:
+            flows = sorted(self.top, key=lambda flow: flow.bytes, reverse=True)
+        return [flow.info() for flow in flows]
+
+    def stats(self):
+        return {
+            "active": len(self.flows),
+            "expired": self.expired,
+            "untracked": self.untracked,
+            "top": self.top_talkers(),
+        }
+
+
+def merge_flow_stats(stats, other):
+    """ Flow stats of two processes (multi-queue workers) as one """
+    if not stats:
+        return other
+    top = sorted(stats["top"] + other["top"], key=lambda flow: flow["sent"] + flow["received"], reverse=True)
+    return {
+        "active": stats["active"] + other["active"],
+        "expired": stats["expired"] + other["expired"],
+        "untracked": stats["untracked"] + other["untracked"],
+        "top": top[:TOP_TALKERS],
+    }
+
+def _packed(address):
+    return IPV4_ADDRESS.pack(address) if isinstance(address, int) else address
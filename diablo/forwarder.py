@@ -1,43 +1,355 @@
 import os
+import time
+import select
+import signal
+import socket
 import threading
 from .terminal import Terminal
+from .settings import Settings
+from .protocol import FrameReader, FrameError, FRAME_HEADER, FRAME_DATA, FRAME_CONTROL, FRAME_COMPRESSED, HEADER_SIZE
+from .sessions import packet_source
+from .tun import DEFAULT_MTU
 
-def start_forwarding(tun_fd, tls_socket):
+DEFAULT_BATCH_PACKETS = 32
+DEFAULT_FLUSH_MS = 1
+MAX_BATCH_BYTES = 64 * 1024
+INGRESS_WAIT = 1.0
+
+class ShutdownSignal(Exception):
+    """ Raised in the main thread by SIGTERM / SIGHUP to start teardown """
+
+def _raise_shutdown(signum, frame):
+    raise ShutdownSignal(signal.Signals(signum).name)
+
+def _install_signal_handlers():
+    """ Route SIGTERM (sent by 'diablo stop') and SIGHUP to the teardown path, returns previous handlers """
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+    previous = {}
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        previous[signum] = signal.signal(signum, _raise_shutdown)
+    return previous
+
+def _restore_signal_handlers(previous):
+    for signum, handler in previous.items():
+        signal.signal(signum, handler)
+
+def start_worker(target, args, stop):
+    """ Run target in a daemon thread, a worker exiting for any reason wakes the main thread """
+    def run():
+        try:
+            target(*args)
+        finally:
+            stop.set()
+    worker = threading.Thread(target=run, name=target.__name__, daemon=True)
+    worker.start()
+    return worker
+
+def wait_for_shutdown(stop, reason="connection closed"):
+    """
+    Park the main thread until stop is set (a worker exited) or Ctrl+C / SIGTERM / SIGHUP
+    arrives. Returns the reason, stop is always set on return.
+    """
+    previous_handlers = _install_signal_handlers()
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        reason = "interrupted"
+    except ShutdownSignal as sig:
+        reason = f"received {sig}"
+    finally:
+        stop.set()
+        _restore_signal_handlers(previous_handlers)
+    return reason
+
+def forwarding_options(config=None):
+    """ (max_batch, flush_ms) for the TUN readers """
+    config = config if config is not None else Settings.values()
+    max_batch = max(1, config.get("batch_max_packets", DEFAULT_BATCH_PACKETS))
+    flush_ms = max(0, config.get("batch_flush_ms", DEFAULT_FLUSH_MS))
+    return max_batch, flush_ms
+
+def _teardown(tun_fd, tls_socket, wake_w, workers):
+    """ Wake both workers, wait briefly for them to exit, then release the TUN fd and TLS socket """
+    try:
+        os.write(wake_w, b"\0")
+    except OSError:
+        pass
+    try:
+        tls_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    for worker in workers:
+        worker.join(timeout=1)
+    tls_socket.close()
+    os.close(tun_fd)
+    os.close(wake_w)
+
+def start_forwarding(tun_fd, tls_socket, on_control=None, mtu=DEFAULT_MTU, compressor=None):
     """
     Start two threads:
     1. TUN -> TLS (client to proxy)
     2. TLS -> TUN (proxy to client)
+    The main thread then sleeps on an event until a worker fails, the peer closes
+    the connection, or a Ctrl+C / SIGTERM / SIGHUP arrives. compressor is the
+    Compressor for the method negotiated in the handshake, if any.
     """
-    threading.Thread(target=tun_to_socket, args=(tun_fd, tls_socket), daemon=True).start()
-    threading.Thread(target=socket_to_tun, args=(tls_socket, tun_fd), daemon=True).start()
+    config = Settings.values()
+    max_batch, flush_ms = forwarding_options(config)
+
+    if config.get("data_plane", "threads") == "asyncio":
+        from .async_forwarder import start_async_forwarding
+        start_async_forwarding(tun_fd, tls_socket, on_control, max_batch, mtu, compressor)
+        return
+
+    stop = threading.Event()
+    wake_r, wake_w = os.pipe()
+    workers = [
+        start_worker(tun_to_socket, (tun_fd, tls_socket, max_batch, flush_ms, mtu, stop, wake_r, compressor), stop),
+        start_worker(socket_to_tun, (tls_socket, tun_fd, on_control, mtu, stop, compressor), stop),
+    ]
 
     Terminal.log("[*] Forwarding started. Press Ctrl+C to exit.")
-    try:
-        while True:
-            pass  # keep main thread alive
-    except KeyboardInterrupt:
-        Terminal.write(Terminal.get_color_bold("\n[!] Shutting down Diablo.", "star"))
-        tls_socket.close()
-        os.close(tun_fd)
+    reason = wait_for_shutdown(stop)
+    Terminal.write(Terminal.get_color_bold(f"\n[!] Shutting down Diablo ({reason}).\n", "star"))
+    _teardown(tun_fd, tls_socket, wake_w, workers)
+    os.close(wake_r)
 
-def tun_to_socket(tun_fd, tls_socket):
-    while True:
+def batch_buffer(mtu):
+    """ Preallocated buffer a batch of frames is read into, always room for at least one packet """
+    return bytearray(max(MAX_BATCH_BYTES, HEADER_SIZE + mtu))
+
+def _read_frames(tun_fd, poller, batch, view, starts, mtu, max_batch, deadline):
+    """
+    Non-blocking reads straight into the preallocated batch buffer, each packet
+    lands right behind a DATA frame header that is packed in place, so no bytes
+    object is created per packet. Stops when the TUN device runs dry (EAGAIN),
+    max_batch packets were read or there is no room for another MTU sized
+    packet. If a deadline is given, keep waiting for packets until it passes.
+    The offset every frame starts at is stored in starts (reused between
+    batches), returns the end of the last frame.
+    """
+    starts.clear()
+    end = 0
+    limit = len(batch) - HEADER_SIZE - mtu
+    while len(starts) < max_batch and end <= limit:
         try:
-            packet = os.read(tun_fd, 2048)
-            if packet:
-                tls_socket.sendall(packet)
+            length = os.readv(tun_fd, [view[end + HEADER_SIZE:end + HEADER_SIZE + mtu]])
+        except BlockingIOError:
+            if deadline is None:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not poller.poll(remaining * 1000):
+                break
+            continue
+        if length:
+            FRAME_HEADER.pack_into(batch, end, length, FRAME_DATA)
+            starts.append(end)
+            end += HEADER_SIZE + length
+    return end
+
+def _batch_full(batch, starts, end, mtu, max_batch):
+    return len(starts) >= max_batch or end > len(batch) - HEADER_SIZE - mtu
+
+def _tun_poller(tun_fd, wake_fd):
+    os.set_blocking(tun_fd, False)
+    poller = select.poll()
+    poller.register(tun_fd, select.POLLIN)
+    if wake_fd is not None:
+        poller.register(wake_fd, select.POLLIN)
+    return poller
+
+def compress_batch(compressor, view, starts, end, out):
+    """ Copy a batch of DATA frames into out, every frame that compresses well replaced by a COMPRESSED one """
+    out.clear()
+    last = len(starts) - 1
+    for i, start in enumerate(starts):
+        frame_end = starts[i + 1] if i < last else end
+        out += compressor.frame(view[start + HEADER_SIZE:frame_end]) or view[start:frame_end]
+    return out
+
+def decompress_frame(compressor, payload):
+    if compressor is None:
+        raise FrameError("Compressed frame, but no compression was negotiated")
+    return compressor.decompress(payload)
+
+def tun_to_socket(tun_fd, tls_socket, max_batch=DEFAULT_BATCH_PACKETS, flush_ms=DEFAULT_FLUSH_MS, mtu=DEFAULT_MTU,
+                  stop=None, wake_fd=None, compressor=None):
+    """
+    Coalesce every packet the TUN device has ready into a single TLS write.
+    Only when the previous batch came back full (bulk transfer) do we wait up to
+    flush_ms for more packets, otherwise the batch is flushed right away so
+    interactive traffic doesn't pay any extra latency.
+    """
+    poller = _tun_poller(tun_fd, wake_fd)
+    batch = batch_buffer(mtu)
+    view = memoryview(batch)
+    starts = []
+    compressed = bytearray()
+    bulk = False
+    while stop is None or not stop.is_set():
+        try:
+            if any(fd == wake_fd for fd, _ in poller.poll()):
+                break
+            deadline = time.monotonic() + flush_ms / 1000 if bulk and flush_ms else None
+            end = _read_frames(tun_fd, poller, batch, view, starts, mtu, max_batch, deadline)
+            bulk = _batch_full(batch, starts, end, mtu, max_batch)
+            if starts and compressor is not None:
+                tls_socket.sendall(compress_batch(compressor, view, starts, end, compressed))
+            elif starts:
+                tls_socket.sendall(view[:end])
         except Exception as e:
-            Terminal.error(f"[-] Error in tun_to_socket: {e}")
+            if stop is None or not stop.is_set():
+                Terminal.error(f"[-] Error in tun_to_socket: {e}", exit=False)
             break
 
-def socket_to_tun(tls_socket, tun_fd):
-    while True:
+def socket_to_tun(tls_socket, tun_fd, on_control=None, mtu=DEFAULT_MTU, stop=None, compressor=None):
+    """ Reassemble frames from the TLS stream, DATA (and decompressed COMPRESSED) payloads go to the TUN device """
+    reader = FrameReader(max_payload=mtu)
+    while stop is None or not stop.is_set():
         try:
-            data = tls_socket.recv(2048)
-            if data:
-                os.write(tun_fd, data)
+            if not reader.fill(tls_socket):
+                if stop is None or not stop.is_set():
+                    Terminal.log("Peer closed the TLS connection")
+                break
+            for frame_type, payload in reader.frames():
+                if frame_type == FRAME_DATA:
+                    os.write(tun_fd, payload)
+                elif frame_type == FRAME_COMPRESSED:
+                    os.write(tun_fd, decompress_frame(compressor, payload))
+                elif frame_type == FRAME_CONTROL and on_control is not None:
+                    on_control(payload)
         except Exception as e:
-            Terminal.error(f"[-] Error in tun_to_socket: {e}")
+            if stop is None or not stop.is_set():
+                Terminal.error(f"[-] Error in socket_to_tun: {e}", exit=False)
             break
 
+def tun_dispatch(tun_fd, sessions, ring, max_batch=DEFAULT_BATCH_PACKETS, flush_ms=DEFAULT_FLUSH_MS,
+                 mtu=DEFAULT_MTU, stop=None, wake_fd=None, packet_filter=None, flows=None):
+    """
+    Server side TUN reader shared by every client. Each packet is routed to the
+    session owning its destination address (one dict lookup) and its frame is
+    copied into that session's staging buffer from the ring, so every session
+    touched by the batch gets its frames queued in one piece without building
+    any bytes objects. Queues are drained by each session's writer_loop, so
+    this thread never blocks on a client. For sessions with compression the
+    frame is swapped for a COMPRESSED one when the packet shrinks, packets
+    over a session's egress rate limit or rejected by packet_filter are dropped.
+    Packets that get through are counted in flows (see flows.FlowTable).
+    """
+    poller = _tun_poller(tun_fd, wake_fd)
+    batch = batch_buffer(mtu)
+    view = memoryview(batch)
+    starts = []
+    staging = {}
+    bulk = False
+    while stop is None or not stop.is_set():
+        try:
+            if any(fd == wake_fd for fd, _ in poller.poll()):
+                break
+            deadline = time.monotonic() + flush_ms / 1000 if bulk and flush_ms else None
+            end = _read_frames(tun_fd, poller, batch, view, starts, mtu, max_batch, deadline)
+            bulk = _batch_full(batch, starts, end, mtu, max_batch)
+            if packet_filter is not None:
+                packet_filter.refresh()
+            last = len(starts) - 1
+            for i, start in enumerate(starts):
+                frame_end = starts[i + 1] if i < last else end
+                session = sessions.route(view[start + HEADER_SIZE:frame_end])
+                if session is None:
+                    continue
+                if packet_filter is not None and not packet_filter.allows(view[start + HEADER_SIZE:frame_end], True):
+                    session.blocked += 1
+                    continue
+                if flows is not None:
+                    flows.count(view[start + HEADER_SIZE:frame_end], True)
+                if session.egress is not None and not session.egress.allow(frame_end - start - HEADER_SIZE):
+                    session.dropped += 1
+                    continue
+                frame = view[start:frame_end]
+                if session.compressor is not None:
+                    frame = session.compressor.frame(view[start + HEADER_SIZE:frame_end]) or frame
+                buffer = staging.get(session)
+                if buffer is not None and buffer.room < len(frame):
+                    session.enqueue(staging.pop(session))
+                    buffer = None
+                if buffer is None:
+                    buffer = ring.acquire()
+                    if buffer is None:
+                        session.dropped += 1  # every buffer is queued somewhere, shed load
+                        continue
+                    staging[session] = buffer
+                buffer.append(frame)
+            for session, buffer in staging.items():
+                session.enqueue(buffer)
+            staging.clear()
+        except Exception as e:
+            if stop is None or not stop.is_set():
+                Terminal.error(f"[-] Error in tun_dispatch: {e}", exit=False)
+            break
+
+class TunWriter:
+    """
+    Writes packets to a non-blocking TUN device. While the device's queue is
+    full packets are dropped like a congested link would drop them and counted
+    in dropped, any other error is raised.
+    """
 
+    __slots__ = ("tun_fd", "dropped")
+
+    def __init__(self, tun_fd):
+        self.tun_fd = tun_fd
+        self.dropped = 0
+
+    def write(self, packet):
+        try:
+            os.write(self.tun_fd, packet)
+        except BlockingIOError:
+            self.dropped += 1
+
+def queue_ingress(session, tun_queue, packet):
+    """
+    Copy a client's packet into the FairQueue in front of the TUN device. While
+    the session's share of the queue is full or it is over its ingress rate
+    this blocks the session's reader, so TCP pushes back on that client alone.
+    """
+    while not tun_queue.put(session, packet, INGRESS_WAIT):
+        if session.closed:
+            return
+    if session.ingress is not None:
+        wait = session.ingress.charge(len(packet))
+        if wait:
+            time.sleep(wait)
+
+def session_to_tun(session, tun_queue, on_control=None, stop=None, packet_filter=None, flows=None):
+    """
+    Per-client TLS reader on the server. Packets are only passed on to the TUN
+    device (through tun_queue, see shaping.FairQueue) if their source is the
+    tunnel IP the client was given and packet_filter lets them through.
+    """
+    reader = FrameReader(max_payload=session.mtu)
+    while stop is None or not stop.is_set():
+        try:
+            if not reader.fill(session.conn):
+                break
+            if packet_filter is not None:
+                packet_filter.refresh()
+            for frame_type, payload in reader.frames():
+                if frame_type == FRAME_COMPRESSED:
+                    payload = decompress_frame(session.compressor, payload)
+                    frame_type = FRAME_DATA
+                if frame_type == FRAME_DATA:
+                    if packet_source(payload) != session.address:
+                        continue
+                    if packet_filter is not None and not packet_filter.allows(payload, False):
+                        session.blocked += 1
+                        continue
+                    if flows is not None:
+                        flows.count(payload, False)
+                    queue_ingress(session, tun_queue, payload)
+                elif frame_type == FRAME_CONTROL and on_control is not None:
+                    on_control(session, payload)
+        except Exception as e:
+            if stop is None or not stop.is_set():
+                Terminal.error(f"[-] Error in session_to_tun ({session.ip}): {e}", exit=False)
+            break
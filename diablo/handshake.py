@@ -0,0 +1,246 @@
+"""
+Connection setup between client and server, after TCP connect and before
+the data plane takes over:
+
+    client                                     server
+      | ------------- TLS handshake -------------> |  TLS stage
+      | -- hello: versions, MTU, compression, ---> |  HELLO stage
+      |           credentials                      |
+      | <-- reply: auth ok / fail, version, MTU, - |  AUTH stage
+      |           compression, tunnel address      |
+
+Handshake messages are JSON in CONTROL frames (see protocol.py), so one
+split across TLS records is reassembled and one that never completes is
+caught. The sockets are non-blocking for the whole exchange and every stage
+has its own deadline, a client that stalls anywhere costs its handshake
+worker a bounded amount of time. Everything the tunnel needs is negotiated
+in the hello and its reply, one round trip after TLS.
+"""
+import ssl
+import json
+import time
+import select
+from .protocol import FRAME_HEADER, HEADER_SIZE, FRAME_CONTROL, encode_frame
+from .terminal import Terminal
+from .tun import negotiate_mtu
+from .compression import COMPRESSION_NONE
+from .audit import Audit, AUTH_FAIL
+
+PROTOCOL_VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+MAX_MESSAGE = 4096
+
+TLS_TIMEOUT = 10     # TCP connect + TLS handshake
+HELLO_TIMEOUT = 5    # client hello, once TLS is up
+REPLY_TIMEOUT = 45   # server reply, covers password hashing and waiting for an admission slot
+
+
+class HandshakeError(Exception):
+    """ The peer broke the handshake protocol or missed a deadline """
+
+
+class HandshakeTimeout(HandshakeError):
+    pass
+
+
+def _wait(sock, deadline, write=False):
+    """ Block until sock is readable (or writable) or raise HandshakeTimeout at deadline """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise HandshakeTimeout("deadline passed")
+    ready = select.select([], [sock], [], remaining) if write else select.select([sock], [], [], remaining)
+    if not any(ready):
+        raise HandshakeTimeout("deadline passed")
+
+def complete_tls(conn, deadline):
+    """ Drive the TLS handshake of a socket wrapped with do_handshake_on_connect=False """
+    conn.setblocking(False)
+    while True:
+        try:
+            conn.do_handshake()
+            return
+        except ssl.SSLWantReadError:
+            _wait(conn, deadline)
+        except ssl.SSLWantWriteError:
+            _wait(conn, deadline, write=True)
+
+def _recv_exact(conn, size, deadline):
+    """ Exactly size bytes, never more, so nothing that follows the message is consumed """
+    data = bytearray()
+    while len(data) < size:
+        try:
+            chunk = conn.recv(size - len(data))
+        except (ssl.SSLWantReadError, BlockingIOError):
+            _wait(conn, deadline)
+            continue
+        except ssl.SSLWantWriteError:
+            _wait(conn, deadline, write=True)
+            continue
+        if not chunk:
+            raise HandshakeError("connection closed during handshake")
+        data += chunk
+    return bytes(data)
+
+def read_message(conn, deadline):
+    """ Next handshake message from a non-blocking TLS socket, as a dict """
+    length, frame_type = FRAME_HEADER.unpack(_recv_exact(conn, HEADER_SIZE, deadline))
+    if frame_type != FRAME_CONTROL:
+        raise HandshakeError(f"Expected a control frame, got type {frame_type:#04x}")
+    if length > MAX_MESSAGE:
+        raise HandshakeError(f"Handshake message of {length} bytes is too large")
+    try:
+        message = json.loads(_recv_exact(conn, length, deadline))
+    except ValueError as e:
+        raise HandshakeError(f"Malformed handshake message: {e}")
+    if not isinstance(message, dict):
+        raise HandshakeError("Malformed handshake message")
+    return message
+
+def send_message(conn, message, deadline=None):
+    """ Write one handshake message. Blocking sockets ignore deadline """
+    data = memoryview(encode_frame(FRAME_CONTROL, json.dumps(message).encode()))
+    deadline = deadline if deadline is not None else time.monotonic() + TLS_TIMEOUT
+    while data:
+        try:
+            sent = conn.send(data)
+        except (ssl.SSLWantWriteError, BlockingIOError):
+            _wait(conn, deadline, write=True)
+            continue
+        except ssl.SSLWantReadError:
+            _wait(conn, deadline)
+            continue
+        data = data[sent:]
+
+# Optional hello fields and the types a client may send them as
+HELLO_FIELDS = {"versions": list, "compression": list, "mtu": int, "name": str, "client_id": str, "auth": dict}
+AUTH_FIELDS = {"token": str, "password": str}
+
+def check_hello(hello):
+    """ Raise HandshakeError unless every field of a client hello has the type the server expects """
+    for fields, message in ((HELLO_FIELDS, hello), (AUTH_FIELDS, hello.get("auth") or {})):
+        for key, kind in fields.items():
+            value = message.get(key)
+            if value is not None and (not isinstance(value, kind) or isinstance(value, bool)):
+                raise HandshakeError(f"malformed hello, '{key}' has the wrong type")
+    if not all(isinstance(method, str) for method in hello.get("compression") or ()):
+        raise HandshakeError("malformed hello, 'compression' is not a list of names")
+    if not all(isinstance(version, int) for version in hello.get("versions") or ()):
+        raise HandshakeError("malformed hello, 'versions' is not a list of numbers")
+
+def negotiate_version(offered):
+    """ Highest protocol version both ends speak, None if there is none """
+    common = set(offered or ()) & set(SUPPORTED_VERSIONS)
+    return max(common) if common else None
+
+def negotiate(hello, mtu, compression=(COMPRESSION_NONE,)):
+    """
+    Tunnel parameters for the reply to hello: the smaller of both MTUs and the
+    first compression method in the client's order the server also supports.
+    """
+    offered = hello.get("compression") or [COMPRESSION_NONE]
+    return {
+        "version": hello.get("version", PROTOCOL_VERSION),
+        "mtu": negotiate_mtu(hello.get("mtu"), mtu),
+        "compression": next((method for method in offered if method in compression), COMPRESSION_NONE),
+    }
+
+
+class ServerHandshake:
+    """
+    Server side of connection setup for one client, run by a HandshakePool
+    worker. Moves through the TLS, HELLO and AUTH stages, each with its own
+    deadline. run() returns the TLS connection (blocking again) and the hello
+    once the client is authenticated, the caller replies with send_auth_ok
+    after assigning a tunnel address. A resume token (see
+    Authentication.issue_token) is accepted instead of the password, so
+    reconnects skip argon2, and sets hello["resumed"].
+    """
+
+    def __init__(self, raw_conn, addr, ctx, password_required):
+        self.raw_conn = raw_conn
+        self.addr = addr
+        self.ctx = ctx
+        self.password_required = password_required
+        self.conn = None
+        self.stage = "tls"
+        self.resumed = False
+
+    def run(self):
+        try:
+            self.conn = self.ctx.wrap_socket(self.raw_conn, server_side=True, do_handshake_on_connect=False)
+            complete_tls(self.conn, time.monotonic() + TLS_TIMEOUT)
+
+            self.stage = "hello"
+            hello = read_message(self.conn, time.monotonic() + HELLO_TIMEOUT)
+            try:
+                check_hello(hello)
+            except HandshakeError as e:
+                self._fail(str(e))
+                return None, None
+            hello["version"] = negotiate_version(hello.get("versions"))
+            if hello["version"] is None:
+                self._fail(f"unsupported protocol version, server speaks {list(SUPPORTED_VERSIONS)}")
+                return None, None
+
+            self.stage = "auth"
+            reason = self._authenticate(hello)
+            if reason is not None:
+                self._fail(reason)
+                return None, None
+            hello["resumed"] = self.resumed  # set by us, never what the client sent
+        except HandshakeTimeout:
+            Terminal.warn(f"Handshake with {self.addr[0]} timed out in the {self.stage} stage")
+            self._close()
+            return None, None
+        except (OSError, ssl.SSLError, HandshakeError) as e:
+            Terminal.warn(f"Handshake with {self.addr[0]} failed in the {self.stage} stage: {e}")
+            self._close()
+            return None, None
+        self.conn.setblocking(True)
+        return self.conn, hello
+
+    def _authenticate(self, hello):
+        """
+        None if the client may connect, otherwise the reason it may not. A
+        valid resume token also proves the client owns its client_id, so it
+        is checked even when no password is required.
+        """
+        from .auth import Authentication
+        credentials = hello.get("auth") or {}
+        token = credentials.get("token")
+        if token and hello.get("client_id"):
+            self.resumed = Authentication.verify_token(token, hello["client_id"])
+        if not self.password_required or self.resumed:
+            return None
+        if token and not credentials.get("password"):
+            return "invalid or expired resume token"
+        if Authentication.verify_password(credentials.get("password", "")):
+            return None
+        return "invalid password"
+
+    def _fail(self, reason):
+        Audit.record(AUTH_FAIL, b=self.addr[0], port_b=self.addr[1])
+        try:
+            send_message(self.conn, {"auth": "fail", "reason": reason}, time.monotonic() + HELLO_TIMEOUT)
+        except (OSError, HandshakeError):
+            pass
+        self._close()
+
+    def _close(self):
+        (self.conn or self.raw_conn).close()
+
+
+def client_handshake(conn, hello, credentials):
+    """
+    Client side of the HELLO and AUTH stages on an established TLS connection.
+    Sends hello with our protocol versions and credentials and returns the
+    server's reply, with the negotiated version, MTU and compression if the
+    server accepted us.
+    """
+    conn.setblocking(False)
+    try:
+        send_message(conn, {**hello, "versions": list(SUPPORTED_VERSIONS), "auth": credentials},
+                     time.monotonic() + HELLO_TIMEOUT)
+        return read_message(conn, time.monotonic() + REPLY_TIMEOUT)
+    finally:
+        conn.setblocking(True)
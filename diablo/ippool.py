@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import threading
+import ipaddress
+from .status import STATUS_FILE
+
+LEASES_FILE = STATUS_FILE.parent / "leases.json"
+
+class IPPool:
+    """
+    Tunnel addresses handed out from a subnet. Every address that is reserved
+    (network, broadcast, server) or leased has its bit set in an int bitmap, so
+    finding a free address is a single lowest-zero-bit operation. Leases are
+    keyed by client identity and persisted in leases.json next to status.json,
+    a reconnecting client gets its old address back with one dict lookup.
+    Offline leases are only reclaimed (oldest first) once the subnet runs out.
+
+    Identities are whatever the client claims, so an existing lease is only
+    handed back when the claim is proven (a resume token, see
+    Authentication.issue_token). An unproven claim gets a new address: the
+    old lease is dropped if nobody is connected with it, otherwise the client
+    gets a temporary lease that is forgotten when it disconnects.
+    """
+
+    def __init__(self, subnet="10.8.0.0/24", server_ip=None, leases_file=LEASES_FILE):
+        self.network = ipaddress.IPv4Network(subnet, strict=False)
+        self.base = int(self.network.network_address)
+        self.size = self.network.num_addresses
+        self.mask = (1 << self.size) - 1
+        self.leases_file = leases_file
+        self.bitmap = 0
+        self.leases = {}    # identity -> {"ip": str, "last_seen": int}
+        self.active = set() # identities currently connected
+        self.temporary = set()  # identities of temporary leases, never saved
+        self._next_temporary = 0
+        self._lock = threading.Lock()
+
+        self._reserve(self.base)
+        self._reserve(self.base + self.size - 1)
+        if server_ip is not None:
+            if ipaddress.IPv4Address(server_ip) not in self.network:
+                raise ValueError(f"Server IP {server_ip} is outside the tunnel subnet {self.network}")
+            self._reserve(int(ipaddress.IPv4Address(server_ip)))
+        self._load()
+
+    @property
+    def netmask(self):
+        return str(self.network.netmask)
+
+    def _offset(self, ip):
+        return int(ipaddress.IPv4Address(ip)) - self.base
+
+    def _reserve(self, address):
+        self.bitmap |= 1 << (address - self.base)
+
+    def _load(self):
+        """ Restore leases from disk, dropping any that no longer fit the subnet """
+        try:
+            with open(self.leases_file, "r") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        for identity, lease in saved.items():
+            try:
+                offset = self._offset(lease["ip"])
+            except (KeyError, ValueError):
+                continue
+            if 0 <= offset < self.size and not (self.bitmap >> offset) & 1:
+                self.bitmap |= 1 << offset
+                self.leases[identity] = lease
+
+    def _save(self):
+        os.makedirs(self.leases_file.parent, exist_ok=True)
+        tmp = self.leases_file.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({identity: lease for identity, lease in self.leases.items() if identity not in self.temporary},
+                      f, indent=2)
+        os.replace(tmp, self.leases_file)
+
+    def _drop(self, identity):
+        """ Forget a lease and free its address. Caller holds the lock """
+        self.bitmap &= ~(1 << self._offset(self.leases.pop(identity)["ip"]))
+        self.temporary.discard(identity)
+
+    def _free_offset(self):
+        free = ~self.bitmap & self.mask
+        if free:
+            return (free & -free).bit_length() - 1
+        # Subnet exhausted, reclaim the lease of whoever has been offline the longest
+        offline = [identity for identity in self.leases if identity not in self.active]
+        if not offline:
+            return None
+        oldest = min(offline, key=lambda identity: self.leases[identity].get("last_seen", 0))
+        offset = self._offset(self.leases.pop(oldest)["ip"])
+        self.bitmap &= ~(1 << offset)
+        return offset
+
+    def acquire(self, identity, proven=True):
+        """
+        (identity, address) for a client, identity is the one to release with
+        later. The previous lease of identity is only reused when proven,
+        (None, None) if the pool is exhausted.
+        """
+        with self._lock:
+            lease = self.leases.get(identity)
+            if lease is not None and not proven:
+                if identity in self.active:
+                    self._next_temporary += 1
+                    identity = f"{identity}#{self._next_temporary}"
+                    self.temporary.add(identity)
+                else:
+                    self._drop(identity)
+                lease = None
+            if lease is None:
+                offset = self._free_offset()
+                if offset is None:
+                    self.temporary.discard(identity)
+                    return None, None
+                self.bitmap |= 1 << offset
+                lease = {"ip": str(ipaddress.IPv4Address(self.base + offset))}
+                self.leases[identity] = lease
+            lease["last_seen"] = int(time.time())
+            self.active.add(identity)
+            self._save()
+            return identity, lease["ip"]
+
+    def release(self, identity):
+        """ Client disconnected, the lease is kept for when it comes back unless it was temporary """
+        with self._lock:
+            self.active.discard(identity)
+            if identity in self.temporary:
+                self._drop(identity)
+                return
+            lease = self.leases.get(identity)
+            if lease is not None:
+                lease["last_seen"] = int(time.time())
+                self._save()
+
+    def in_use(self):
+        return len(self.active)
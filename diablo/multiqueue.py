@@ -0,0 +1,363 @@
+"""
+Multi-queue server data plane, enabled with "tun_queues" > 1 in config.json.
+The TUN device is created with IFF_MULTI_QUEUE and every queue is serviced by
+its own forked worker process, pinned to a core, so forwarding is no longer
+capped by a single GIL. The main process keeps what has to be global: it
+accepts TCP connections and hands the raw fd (SCM_RIGHTS) to the least loaded
+worker, owns the IP pool and admission control, and writes status.json.
+Workers do the TLS handshake and run the regular data plane
+(Server.run_data_plane) on their queue, asking the main process for leases
+over a small JSON RPC channel.
+
+The kernel spreads TUN packets over the queues by flow hash, not by client,
+so a packet can come out of a queue whose worker doesn't own its destination.
+Which worker owns every tunnel address is kept in a shared mmap (one byte per
+address, worker index + 1) and misrouted packets are passed to the owner's
+inbox, a datagram socketpair the owner reads like a second TUN queue.
+"""
+import os
+import json
+import mmap
+import time
+import signal
+import socket
+import threading
+from .terminal import Terminal
+from .settings import Settings
+from .sessions import SessionTable, packet_destination
+from .forwarder import wait_for_shutdown
+from .server import Server
+from .tls_handler import HandshakePool, HANDSHAKE_WORKERS, HANDSHAKE_QUEUE
+from .buffers import BufferRing
+from .audit import Audit
+from .status import Status
+
+RPC_MESSAGE = 64 * 1024
+WORKER_EXIT_WAIT = 3
+
+class RpcClient:
+    """ Worker side of the RPC channel, any thread can call() while one thread reads the replies """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.waiting = {}   # request id -> [Event, reply]
+        self.next_id = 0
+        threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def call(self, op, **args):
+        """ Blocks until the main process answers, {} if it went away """
+        slot = [threading.Event(), {}]
+        try:
+            with self.lock:
+                self.next_id += 1
+                self.waiting[self.next_id] = slot
+                self.sock.send(json.dumps({"id": self.next_id, "op": op, **args}).encode())
+        except OSError:
+            return {}
+        slot[0].wait()
+        return slot[1]
+
+    def notify(self, op, **args):
+        """ Fire and forget, no reply """
+        try:
+            with self.lock:
+                self.sock.send(json.dumps({"id": None, "op": op, **args}).encode())
+        except OSError:
+            pass
+
+    def _read_replies(self):
+        while True:
+            try:
+                data = self.sock.recv(RPC_MESSAGE)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            reply = json.loads(data)
+            slot = self.waiting.pop(reply.pop("id"), None)
+            if slot is not None:
+                slot[1] = reply
+                slot[0].set()
+        with self.lock:
+            for slot in self.waiting.values():
+                slot[0].set()
+            self.waiting.clear()
+
+
+class RemoteAdmission:
+    """ Admission as seen from a worker, slots are counted by the main process """
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    def acquire(self):
+        return self.rpc.call("admit").get("reason", "server is shutting down")
+
+    def release(self):
+        self.rpc.notify("release_slot")
+
+
+class RemotePool:
+    """ IPPool as seen from a worker, leases are handed out by the main process """
+
+    def __init__(self, rpc, network):
+        self.rpc = rpc
+        self.network = network
+
+    def acquire(self, identity, proven=True):
+        reply = self.rpc.call("lease", identity=identity, proven=proven)
+        return reply.get("identity"), reply.get("ip")
+
+    def release(self, identity):
+        self.rpc.notify("release_lease", identity=identity)
+
+
+class ShardedSessionTable(SessionTable):
+    """ Session table of one worker, packets for addresses another worker owns go to that worker's inbox """
+
+    def __init__(self, index, owners, base, inboxes):
+        super().__init__()
+        self.tag = index + 1
+        self.owners = owners
+        self.base = base
+        self.inboxes = inboxes  # write end of every worker's inbox, indexed by worker
+        self.forwarded = 0
+
+    def add(self, session):
+        previous = super().add(session)
+        self.owners[session.address - self.base] = self.tag
+        return previous
+
+    def remove(self, session):
+        removed = super().remove(session)
+        offset = session.address - self.base
+        if removed and self.owners[offset] == self.tag:
+            self.owners[offset] = 0
+        return removed
+
+    def route(self, packet):
+        destination = packet_destination(packet)
+        if destination is None:
+            return None
+        session = self._by_address.get(destination)
+        if session is None:
+            offset = destination - self.base
+            owner = self.owners[offset] if 0 <= offset < len(self.owners) else 0
+            if owner and owner != self.tag:
+                try:
+                    self.inboxes[owner - 1].send(packet)
+                    self.forwarded += 1
+                except OSError:
+                    pass  # inbox full, drop like any other congested queue
+        return session
+
+
+class WorkerHandle:
+    """ Main process bookkeeping for one worker """
+
+    def __init__(self, index, pid, rpc, handoff):
+        self.index = index
+        self.pid = pid
+        self.rpc = rpc
+        self.handoff = handoff
+        self.send_lock = threading.Lock()
+        self.clients = []   # latest session infos the worker reported
+        self.handshakes = {}
+        self.blocked_ports = {}
+        self.flows = None
+        self.tun_dropped = 0
+        self.handed_off = 0
+
+    def reply(self, request_id, **result):
+        try:
+            with self.send_lock:
+                self.rpc.send(json.dumps({"id": request_id, **result}).encode())
+        except OSError:
+            pass
+
+
+def _worker_cpus(count):
+    """ CPU to pin each worker to, None if pinning is off or not possible """
+    if not Settings.get("pin_workers", True) or not hasattr(os, "sched_getaffinity"):
+        return [None] * count
+    cpus = sorted(os.sched_getaffinity(0))
+    return [cpus[i % len(cpus)] for i in range(count)]
+
+def _run_worker(index, queue_fd, inbox, inboxes, handoff, rpc, owners, base, ctx, cpu):
+    """ Body of a forked worker process, never returns """
+    status = 0
+    try:
+        if cpu is not None:
+            os.sched_setaffinity(0, {cpu})
+        Server.pid = os.getpid()
+        Server.audit_name = f"worker{index}"
+        Server.workers = []
+        Server.tun_fd = queue_fd
+        Server.coordinator = RpcClient(rpc)
+        Server.admission = RemoteAdmission(Server.coordinator)
+        Server.pool = RemotePool(Server.coordinator, Server.pool.network)
+        Server.sessions = ShardedSessionTable(index, owners, base, inboxes)
+        # Fresh pools instead of the copies created in the main process
+        config = Settings.values()
+        Server.handshakes = HandshakePool(config.get("handshake_workers", HANDSHAKE_WORKERS),
+                                          max(0, config.get("handshake_queue", HANDSHAKE_QUEUE)))
+        Server.ring = BufferRing()
+
+        def receive_clients(stop):
+            while not stop.is_set():
+                try:
+                    message, fds, _, _ = socket.recv_fds(handoff, 1024, 1)
+                except OSError:
+                    break
+                if not fds:
+                    break  # main process is gone
+                raw_conn = socket.socket(fileno=fds[0])
+                addr = tuple(json.loads(message))
+                if not Server.handshakes.submit(raw_conn, addr, ctx, Server.password_required, Server._on_client):
+                    Terminal.warn(f"Handshake queue full, dropped connection from {addr[0]}")
+
+        Server.run_data_plane([queue_fd, inbox.fileno()], receive_clients, Settings.values())
+        try:
+            handoff.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        Server.close_sessions()
+        os.close(queue_fd)
+    except BaseException as e:
+        Terminal.error(f"Worker {index} failed: {e}", exit=False)
+        status = 1
+    finally:
+        os._exit(status)
+
+def _serve_rpc(worker, stop):
+    """ Answer one worker's requests until it exits """
+    while True:
+        try:
+            data = worker.rpc.recv(RPC_MESSAGE)
+        except OSError:
+            data = b""
+        if not data:
+            break
+        request = json.loads(data)
+        op = request.get("op")
+        if op == "admit":
+            # Admission can block while the client waits for a free slot, keep the channel responsive
+            threading.Thread(target=lambda rid=request["id"]: worker.reply(rid, reason=Server.admission.acquire()),
+                             daemon=True).start()
+        elif op == "release_slot":
+            Server.admission.release()
+        elif op == "lease":
+            identity, ip = Server.pool.acquire(request["identity"], request.get("proven", True))
+            worker.reply(request["id"], identity=identity, ip=ip)
+        elif op == "release_lease":
+            Server.pool.release(request["identity"])
+        elif op == "status" and not stop.is_set():
+            worker.clients = request.get("clients", [])
+            worker.handshakes = request.get("handshakes", {})
+            worker.blocked_ports = request.get("blocked_ports", {})
+            worker.flows = request.get("flows")
+            worker.tun_dropped = request.get("tun_dropped", 0)
+            Server.save_status()
+    if not stop.is_set():
+        Terminal.warn(f"Worker {worker.index} (pid {worker.pid}) exited")
+        stop.set()
+
+def _hand_off(listener, stop):
+    """ Accept loop of the main process, every connection goes to the worker with the fewest clients """
+    while not stop.is_set():
+        try:
+            raw_conn, addr = listener.accept()
+        except OSError as e:
+            if not stop.is_set():
+                Terminal.error(f"Accept failed: {e}", exit=False)
+                stop.set()
+            break
+        worker = min(Server.workers, key=lambda w: (len(w.clients), w.handed_off))
+        try:
+            socket.send_fds(worker.handoff, [json.dumps(addr).encode()], [raw_conn.fileno()])
+            worker.handed_off += 1
+        except OSError as e:
+            Terminal.warn(f"Could not pass {addr[0]} to worker {worker.index}: {e}")
+        raw_conn.close()
+
+def _stop_workers():
+    for worker in Server.workers:
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + WORKER_EXIT_WAIT
+    for worker in Server.workers:
+        while True:
+            try:
+                pid, _ = os.waitpid(worker.pid, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid or time.monotonic() > deadline:
+                if not pid:
+                    os.kill(worker.pid, signal.SIGKILL)
+                    os.waitpid(worker.pid, 0)
+                break
+            time.sleep(0.05)
+
+def serve_multiqueue(tun_fds, listener, ctx):
+    """ Fork one worker per TUN queue and coordinate them until 'diablo stop', Ctrl+C or a worker dies """
+    config = Settings.values()
+    Server._configure_admission(config)
+    owners = mmap.mmap(-1, Server.pool.size)
+    inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in tun_fds]
+    for _, write_end in inboxes:
+        write_end.setblocking(False)
+    write_ends = [write_end for _, write_end in inboxes]
+    cpus = _worker_cpus(len(tun_fds))
+
+    # Only the forking thread survives in the child, a lock another thread held would stay held forever
+    threads = [thread.name for thread in threading.enumerate() if thread is not threading.current_thread()]
+    if threads:
+        Terminal.error(f"Cannot start the queue workers while other threads are running: {', '.join(threads)}")
+    for index, queue_fd in enumerate(tun_fds):
+        rpc_main, rpc_worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        handoff_main, handoff_worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            rpc_main.close()
+            handoff_main.close()
+            for worker in Server.workers:
+                worker.rpc.close()
+                worker.handoff.close()
+            for other in tun_fds:
+                if other != queue_fd:
+                    os.close(other)
+            _run_worker(index, queue_fd, inboxes[index][0], write_ends, handoff_worker, rpc_worker, owners,
+                        Server.pool.base, ctx, cpus[index])
+        rpc_worker.close()
+        handoff_worker.close()
+        Server.workers.append(WorkerHandle(index, pid, rpc_main, handoff_main))
+        Terminal.log(f"Worker {index} started (pid {pid}{'' if cpus[index] is None else f', cpu {cpus[index]}'})")
+    for queue_fd in tun_fds:
+        os.close(queue_fd)
+
+    stop = threading.Event()
+    for worker in Server.workers:
+        threading.Thread(target=_serve_rpc, args=(worker, stop), daemon=True).start()
+    threading.Thread(target=_hand_off, args=(listener, stop), daemon=True).start()
+    if Server.firewall is not None:
+        Server.firewall.start_watching(stop)
+    if Server.arp is not None:
+        Server.arp.start_watching(stop)
+    Audit.start(config)
+
+    Terminal.log(f"[*] Accepting clients on {len(tun_fds)} queues. Run 'diablo stop' to shut down.")
+    reason = wait_for_shutdown(stop)
+
+    Terminal.write(Terminal.get_color_bold(f"\n[!] Shutting down Diablo server ({reason}).\n", "star"))
+    try:
+        listener.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    listener.close()
+    _stop_workers()
+    Audit.stop()
+    Status.clear_status()
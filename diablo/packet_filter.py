@@ -0,0 +1,151 @@
+"""
+Port filtering on the server's forwarding path, driven by config.json:
+
+    "blocked_ports"     TCP / UDP packets to or from these ports are dropped both ways
+    "filtered_ports"    packets to these ports are dropped on their way to a client, so
+                        nothing outside the tunnel can open a connection to them
+    "monitor_ports"     count the dropped packets per port for 'diablo status'
+    "lockdown_mode"     clients may only reach addresses inside the tunnel subnet
+
+The port lists are compiled into one 65536 bit bitmap per protocol and list,
+rebuilt only when the Settings cache hands out a new config, so checking a
+packet is a header parse plus one or two bit tests however long the lists
+are. Headers are read straight from the memoryview the packet sits in.
+When the rules are loaded into nftables (see firewall.py) the kernel drops
+this traffic before Diablo sees it and the filter stands aside.
+"""
+import threading
+from .settings import Settings
+from .sessions import packet_source, packet_destination
+from .audit import Audit
+
+IP_TCP = 6
+IP_UDP = 17
+PROTOCOLS = (IP_TCP, IP_UDP)
+BITMAP_BYTES = 65536 // 8
+
+IPV6_HEADER = 40
+IPV6_FRAGMENT = 44
+IPV6_EXTENSIONS = frozenset({0, 43, 60})    # hop-by-hop, routing and destination options
+MAX_EXTENSIONS = 4
+
+def transport_ports(packet):
+    """
+    (protocol, source port, destination port) of a TCP / UDP packet over IPv4
+    or IPv6, None for other protocols, fragments after the first and
+    truncated headers.
+    """
+    if len(packet) < 20:
+        return None
+    version = packet[0] >> 4
+    if version == 4:
+        if (packet[6] & 0x1F) or packet[7]:
+            return None  # not the first fragment, no transport header
+        protocol = packet[9]
+        offset = (packet[0] & 0x0F) * 4
+    elif version == 6:
+        protocol = packet[6]
+        offset = IPV6_HEADER
+        for _ in range(MAX_EXTENSIONS):
+            if protocol in IPV6_EXTENSIONS:
+                if len(packet) < offset + 2:
+                    return None
+                protocol, offset = packet[offset], offset + (packet[offset + 1] + 1) * 8
+            elif protocol == IPV6_FRAGMENT:
+                if len(packet) < offset + 8 or (packet[offset + 2] << 8 | packet[offset + 3]) & 0xFFF8:
+                    return None
+                protocol, offset = packet[offset], offset + 8
+            else:
+                break
+    else:
+        return None
+    if protocol not in PROTOCOLS or len(packet) < offset + 4:
+        return None
+    return protocol, packet[offset] << 8 | packet[offset + 1], packet[offset + 2] << 8 | packet[offset + 3]
+
+def compile_ports(ports):
+    """ 65536 bit bitmap with the bit of every valid port in ports set """
+    bitmap = bytearray(BITMAP_BYTES)
+    for port in ports or ():
+        if isinstance(port, int) and 0 <= port <= 65535:
+            bitmap[port >> 3] |= 1 << (port & 7)
+    return bitmap
+
+def _has(bitmap, port):
+    return bitmap[port >> 3] >> (port & 7) & 1
+
+
+class PacketFilter:
+    """
+    Compiled port lists and lockdown mode of one server process, shared by
+    every forwarding thread. refresh() is cheap enough to call once per batch
+    of packets, it only recompiles when config.json changed. network is the
+    tunnel subnet for lockdown mode, firewall the server's Firewall, nothing
+    is checked here while it is active.
+    """
+
+    def __init__(self, network=None, firewall=None):
+        self.base = int(network.network_address) if network is not None else None
+        self.mask = int(network.netmask) if network is not None else None
+        self.firewall = firewall
+        self.config = None
+        self.offloaded = False
+        self.active = False     # anything to enforce at all, lets allows() skip parsing
+        self.blocked = {}       # protocol -> bitmap
+        self.filtered = {}
+        self.lockdown = False
+        self.monitor = False
+        self.hits = {}          # port -> packets dropped, while monitoring
+        self._hits_lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        config = Settings.values()
+        offloaded = self.firewall is not None and self.firewall.active
+        if config is self.config and offloaded == self.offloaded:
+            return
+        blocked = compile_ports(config.get("blocked_ports"))
+        filtered = compile_ports(config.get("filtered_ports"))
+        # Both protocols share the lists in config.json, separate bitmaps leave room for per protocol rules
+        self.blocked = {protocol: blocked for protocol in PROTOCOLS}
+        self.filtered = {protocol: filtered for protocol in PROTOCOLS}
+        self.lockdown = self.base is not None and bool(config.get("lockdown_mode", False))
+        self.active = not offloaded and (any(blocked) or any(filtered) or self.lockdown)
+        self.monitor = bool(config.get("monitor_ports", False))
+        self.offloaded = offloaded
+        self.config = config
+
+    def allows(self, packet, to_client):
+        """ False if packet has to be dropped, to_client for packets read from the TUN device """
+        if not self.active:
+            return True
+        if self.lockdown:
+            address = packet_source(packet) if to_client else packet_destination(packet)
+            if address is None or address & self.mask != self.base:
+                if Audit.aggressive:
+                    Audit.filter_hit(packet, 0, 0, 0)
+                return False
+        ports = transport_ports(packet)
+        if ports is None:
+            return True
+        protocol, source, destination = ports
+        blocked = self.blocked[protocol]
+        if _has(blocked, destination):
+            port = destination
+        elif _has(blocked, source):
+            port = source
+        elif to_client and _has(self.filtered[protocol], destination):
+            port = destination
+        else:
+            return True
+        if self.monitor:
+            with self._hits_lock:
+                self.hits[port] = self.hits.get(port, 0) + 1
+        if Audit.aggressive:
+            Audit.filter_hit(packet, protocol, source, destination)
+        return False
+
+    def stats(self):
+        """ Dropped packets per port (as strings, for JSON), empty unless monitor_ports is on """
+        with self._hits_lock:
+            return {str(port): count for port, count in sorted(self.hits.items())}
@@ -0,0 +1,111 @@
+"""
+Ping / pong control frames, sent by both ends of a tunnel:
+
+    {"type": "ping", "seq": 7, "ts": 1234.567}   ts is the sender's monotonic clock in ms
+    {"type": "pong", "seq": 7, "ts": 1234.567}   echoed back unchanged
+
+Since the pong carries the sender's own timestamp no clock sync is needed.
+Every answered ping is an RTT sample for a smoothed RTT / RTT variance
+estimate (RFC 6298) and an interarrival style jitter estimate (RFC 3550).
+"""
+import json
+import time
+
+PING_INTERVAL = 10      # seconds between pings on a healthy connection
+PING_TICK = 0.25        # how often poll() is called
+DEAD_PEER_PINGS = 3     # pings in a row without an answer before the peer is declared dead
+INITIAL_RTO = 3.0       # before the first sample
+MIN_RTO = 1.0
+MAX_RTO = 30.0
+
+
+class Pinger:
+    """
+    Ping state of one connection, poll() it every PING_TICK seconds and pass
+    it every control frame. A ping counts as lost once it has been
+    unanswered for the retransmission timeout (srtt + 4 * rttvar); the next
+    one goes out straight away instead of after the interval, so a dead peer
+    is noticed within a few RTOs of the last ping rather than after a fixed
+    timeout, and links with more latency get proportionally more slack.
+    """
+
+    __slots__ = ("interval", "max_missed", "seq", "outstanding", "next_ping", "srtt", "rttvar", "jitter",
+                 "last_sample", "missed", "lost", "dead")
+
+    def __init__(self, interval=PING_INTERVAL, max_missed=DEAD_PEER_PINGS):
+        self.interval = max(1, interval)
+        self.max_missed = max(1, max_missed)
+        self.seq = 0
+        self.outstanding = None     # (seq, sent at) of the ping waiting for its pong
+        self.next_ping = time.monotonic() + self.interval
+        self.srtt = None
+        self.rttvar = None
+        self.jitter = 0.0
+        self.last_sample = None
+        self.missed = 0
+        self.lost = 0
+        self.dead = False
+
+    @property
+    def rto(self):
+        if self.srtt is None:
+            return INITIAL_RTO
+        return min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def poll(self, now=None):
+        """ Payload of a ping to send now, None if there is nothing to send (or the peer is dead) """
+        now = time.monotonic() if now is None else now
+        if self.outstanding is not None:
+            if now - self.outstanding[1] < self.rto:
+                return None
+            self.outstanding = None
+            self.lost += 1
+            self.missed += 1
+            if self.missed >= self.max_missed:
+                self.dead = True
+                return None
+        elif now < self.next_ping:
+            return None
+        self.seq += 1
+        self.outstanding = (self.seq, now)
+        self.next_ping = now + self.interval
+        return json.dumps({"type": "ping", "seq": self.seq, "ts": round(now * 1000, 3)}).encode()
+
+    def on_control(self, payload):
+        """ Handle a control frame, returns the pong to send back for a ping and None otherwise """
+        try:
+            message = json.loads(bytes(payload))
+        except ValueError:
+            return None
+        if not isinstance(message, dict):
+            return None
+        kind = message.get("type")
+        if kind == "ping":
+            return json.dumps({"type": "pong", "seq": message.get("seq"), "ts": message.get("ts")}).encode()
+        if kind == "pong" and isinstance(message.get("ts"), (int, float)):
+            # Late pongs for pings already counted as lost still prove the peer is alive
+            self._sample(time.monotonic() - message["ts"] / 1000)
+            self.missed = 0
+            if self.outstanding is not None and message.get("seq") == self.outstanding[0]:
+                self.outstanding = None
+        return None
+
+    def _sample(self, rtt):
+        if rtt < 0:
+            return
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        if self.last_sample is not None:
+            self.jitter += (abs(rtt - self.last_sample) - self.jitter) / 16
+        self.last_sample = rtt
+
+    def stats(self):
+        return {
+            "rtt_ms": round(self.srtt * 1000, 2) if self.srtt is not None else None,
+            "rttvar_ms": round(self.rttvar * 1000, 2) if self.rttvar is not None else None,
+            "jitter_ms": round(self.jitter * 1000, 2),
+            "lost_pings": self.lost,
+        }
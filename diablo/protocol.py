@@ -0,0 +1,92 @@
+"""
+Wire format of the TLS data channel. TLS is a byte stream, so every message
+sent over it is wrapped in a frame:
+
+    +----------------+------------+---------------------+
+    | length (!H, 2) | type (!B)  | payload (length)    |
+    +----------------+------------+---------------------+
+
+DATA frames carry exactly one IP packet read from the TUN device, CONTROL
+frames carry messages between client and proxy (auth, keepalives, ...).
+COMPRESSED frames carry one IP packet compressed with the method negotiated
+in the handshake (see compression.py).
+"""
+import struct
+
+FRAME_HEADER = struct.Struct("!HB")
+HEADER_SIZE = FRAME_HEADER.size
+MAX_PAYLOAD = 0xFFFF
+MAX_FRAME = HEADER_SIZE + MAX_PAYLOAD
+MIN_CAPACITY = 64 * 1024
+
+FRAME_DATA = 0x00
+FRAME_CONTROL = 0x01
+FRAME_COMPRESSED = 0x02
+
+FRAME_TYPES = {FRAME_DATA, FRAME_CONTROL, FRAME_COMPRESSED}
+
+
+class FrameError(Exception):
+    """ Raised when the peer sends something that isn't a valid frame """
+
+
+def encode_frame(frame_type, payload):
+    """ Returns header + payload as a single bytes object, ready for sendall """
+    length = len(payload)
+    if length > MAX_PAYLOAD:
+        raise FrameError(f"Payload of {length} bytes exceeds max frame size")
+    return FRAME_HEADER.pack(length, frame_type) + payload
+
+
+class FrameReader:
+    """
+    Reassembles frames from a TLS socket. Data is received straight into a
+    preallocated buffer with recv_into, and complete frames are handed out as
+    memoryviews into that buffer, so no bytes objects are created per packet.
+    Views returned by frames() are only valid until the next call to fill().
+    With max_payload set (the tunnel MTU) larger frames are rejected and the
+    buffer is sized for that instead of the 64 KiB protocol maximum.
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD, capacity=None):
+        self.max_payload = min(max_payload, MAX_PAYLOAD)
+        self.max_frame = HEADER_SIZE + self.max_payload
+        if capacity is None:
+            capacity = max(MIN_CAPACITY, 2 * self.max_frame)
+        if capacity < self.max_frame:
+            raise ValueError(f"FrameReader capacity must be at least {self.max_frame} bytes")
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def _compact(self):
+        """ Make room for at least one full frame at the end of the buffer """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < self.max_frame:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+
+    def fill(self, sock):
+        """ Receive whatever is available from sock. Returns 0 when the peer closed """
+        self._compact()
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def frames(self):
+        """ Yields (frame_type, payload view) for every complete frame in the buffer """
+        while self.end - self.start >= HEADER_SIZE:
+            length, frame_type = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if frame_type not in FRAME_TYPES:
+                raise FrameError(f"Unknown frame type {frame_type:#04x}")
+            if length > self.max_payload:
+                raise FrameError(f"Frame of {length} bytes exceeds the negotiated limit of {self.max_payload}")
+            frame_end = self.start + HEADER_SIZE + length
+            if frame_end > self.end:
+                return
+            payload = self.view[self.start + HEADER_SIZE:frame_end]
+            self.start = frame_end
+            yield frame_type, payload
@@ -3,17 +3,38 @@ import platform
 import socket 
 import signal
 import time
+import threading
 from textwrap import dedent 
 
-from .tun import setup_tun_interface
-from .tls_handler import start_tls_server
-from .forwarder import start_forwarding
+from .tun import setup_tun_interface, setup_tun_multiqueue, clamp_mtu, DEFAULT_MTU
+from .handshake import negotiate
+from .compression import supported_methods, make_compressor
+from .ping import Pinger, PING_INTERVAL, PING_TICK, DEAD_PEER_PINGS
+from .shaping import FairQueue, make_bucket, DEFAULT_BURST_KB
+from .packet_filter import PacketFilter
+from .firewall import Firewall
+from .arp import ArpProtection
+from .audit import Audit, CONNECT, DISCONNECT
+from .flows import FlowTable, merge_flow_stats, DEFAULT_MAX_FLOWS, DEFAULT_IDLE_TIMEOUT
+from .tls_handler import (start_tls_server, accept_clients, send_auth_ok, send_auth_fail, HandshakePool,
+                          HANDSHAKE_WORKERS, HANDSHAKE_QUEUE)
+from .forwarder import (start_worker, wait_for_shutdown, forwarding_options, tun_dispatch, session_to_tun,
+                        TunWriter)
+from .sessions import Session, SessionTable, Admission
+from .ippool import IPPool
+from .buffers import BufferRing
+from .protocol import encode_frame, FRAME_CONTROL
+from .settings import Settings
 from .terminal import Terminal 
-from .auth import Authentication
+from .auth import Authentication, AUTH_TOKEN_TTL
 from .daemon import daemonize
 from .status import Status
 from .certgen import generate_self_signed_cert
 
+STATUS_INTERVAL = 5
+AUTH_PROCESSES = 2
+_status_lock = threading.Lock()     # save_status is called from handshake, session, refresh and RPC threads
+
 class Server: 
     mode = "server"
     pid = os.getpid()
@@ -23,6 +44,34 @@ class Server:
     password_required = False
     active, status = Status.is_session_active(expected_mode="server")
 
+    server_ip = "10.8.0.1"
+    netmask = "255.255.255.0"
+    mtu = DEFAULT_MTU
+    sessions = SessionTable()
+    pool = None
+    admission = Admission()
+    handshakes = HandshakePool()
+    queue_bytes = 256 * 1024
+    ingress_kbit = 0    # per client rate limits, 0 for unlimited
+    egress_kbit = 0
+    burst_kb = DEFAULT_BURST_KB
+    token_ttl = AUTH_TOKEN_TTL
+    compression = supported_methods("off")
+    ping_interval = PING_INTERVAL
+    dead_peer_pings = DEAD_PEER_PINGS
+    tun_queue = None    # FairQueue in front of the TUN device, threads engine
+    tun_writer = None   # TunWriter draining tun_queue, threads engine
+    packet_filter = None
+    flows = None        # FlowTable while monitor_ports is on
+    firewall = None     # nftables rules for blocked_ports / lockdown_mode, see firewall.py
+    arp = None          # ArpProtection of the LAN interface
+    audit_name = "server"   # audit log directory of this process, see audit.py
+    ring = BufferRing()
+    tun_fd = None
+    engine = None
+    workers = []        # multi-queue worker processes, seen from the main process
+    coordinator = None  # RPC channel to the main process, set inside a multi-queue worker
+
     @staticmethod 
     def _check_platform():
         Terminal.append_animation("Checking platform")
@@ -50,14 +99,58 @@ class Server:
             exit()
         else: 
             Terminal.replace_animation("No current running servers. Proceeding.")
+            Server.save_status()
+
+    @staticmethod
+    def save_status():
+        """ Publish the current session table for 'diablo status' """
+        with _status_lock:
+            Server._save_status()
 
-            Status.save_status({
-                "mode": Server.mode,
-                "pid": Server.pid,
-                "host_ip": Server.host_ip,
-                "connected_clients": Server.connected_clients,
-                "password_required": Server.password_required
-            })
+    @staticmethod
+    def _save_status():
+        clients = [session.info() for session in Server.sessions]
+        handshakes = Server.handshakes.stats()
+        blocked_ports = Server.packet_filter.stats() if Server.packet_filter is not None else {}
+        flows = Server.flows.stats() if Server.flows is not None else None
+        tun_dropped = Server._tun_dropped()
+        if Server.coordinator is not None:
+            # Multi-queue worker, the main process merges every worker's report into status.json
+            Server.coordinator.notify("status", clients=clients, handshakes=handshakes, blocked_ports=blocked_ports,
+                                      flows=flows, tun_dropped=tun_dropped)
+            return
+        for worker in Server.workers:
+            clients.extend(worker.clients)
+            for key, value in worker.handshakes.items():
+                handshakes[key] = handshakes.get(key, 0) + value
+            for port, count in worker.blocked_ports.items():
+                blocked_ports[port] = blocked_ports.get(port, 0) + count
+            if worker.flows:
+                flows = merge_flow_stats(flows, worker.flows)
+            tun_dropped += worker.tun_dropped
+        Server.connected_clients = len(clients)
+        Status.save_status({
+            "mode": Server.mode,
+            "pid": Server.pid,
+            "host_ip": Server.host_ip,
+            "server_ip": Server.server_ip,
+            "connected_clients": Server.connected_clients,
+            "password_required": Server.password_required,
+            "clients": clients,
+            "handshakes": handshakes,
+            "blocked_ports": blocked_ports,
+            "arp": Server.arp.stats() if Server.arp is not None else None,
+            "audit": Audit.stats(),
+            "flows": flows,
+            "tun_dropped": tun_dropped,
+        })
+
+    @staticmethod
+    def _tun_dropped():
+        """ Client packets dropped because the TUN device's queue was full """
+        if Server.engine is not None:
+            return Server.engine.tun_dropped()
+        return Server.tun_writer.dropped if Server.tun_writer is not None else 0
 
     @staticmethod
     def start_server():
@@ -67,25 +160,280 @@ class Server:
         Terminal.newline(2)
         Terminal.loading_animation(starting_msg, marker_color="star")
 
-        time.sleep(2)
-        Terminal.append_animation(line="yo mama")
-        Terminal.stop_animation()
-        
         Server._check_platform()
         Server._check_if_root()
         Server.check_status()
         generate_self_signed_cert()
-        Terminal.pause_animation()
-        time.sleep(2)
-        Terminal.resume_animation()
         Terminal.stop_animation()
+
+        config = Settings.values()
+        Server.server_ip = config.get("default_server_ip", Server.server_ip)
+        try:
+            Server.pool = IPPool(config.get("tunnel_subnet", "10.8.0.0/24"), Server.server_ip)
+        except ValueError as e:
+            Terminal.error(f"Invalid tunnel addressing in config: {e}")
+        Server.netmask = Server.pool.netmask
+        Server.mtu = clamp_mtu(config.get("tunnel_mtu", DEFAULT_MTU))
+        Server.token_ttl = max(0, config.get("auth_token_ttl", AUTH_TOKEN_TTL))
+        Server.compression = supported_methods(config.get("compression", "off"))
+        Server.ping_interval = config.get("keepalive_interval", PING_INTERVAL)
+        Server.dead_peer_pings = config.get("dead_peer_pings", DEAD_PEER_PINGS)
+        interface = config.get("bind_interface") or "tun0"
+        queues = max(1, config.get("tun_queues", 1))
+        if queues > 1:
+            from .multiqueue import serve_multiqueue
+            tun_fds = setup_tun_multiqueue(Server.server_ip, Server.netmask, interface, Server.mtu, queues)
+        else:
+            tun = setup_tun_interface(Server.server_ip, Server.netmask, interface, Server.mtu)
+        Server.firewall = Firewall(interface, Server.pool.network)
+        Server.arp = ArpProtection(config, server=True)
+        try:
+            # Inside the try so a failure part way through still takes down whatever was already loaded
+            Server.firewall.apply(config)
+            Server.arp.apply()
+            listener, ctx, Server.password_required = start_tls_server()
+            Server.save_status()
+            if queues > 1:
+                serve_multiqueue(tun_fds, listener, ctx)
+            else:
+                Server.serve(tun, listener, ctx)
+        finally:
+            Server.firewall.remove()
+            Server.arp.remove()
+
+    @staticmethod
+    def _configure_admission(config):
+        """ max_clients / accept_new_connections / max_pending_clients from config.json """
+        max_clients = str(config.get("max_clients", "unlimited"))
+        Server.admission = Admission(
+            max_clients=int(max_clients) if max_clients.isdigit() else None,
+            max_pending=max(0, config.get("max_pending_clients", 0)),
+            accepting=config.get("accept_new_connections", True),
+        )
+        Server.queue_bytes = max(16, config.get("client_queue_kb", 256)) * 1024
+        Server.ingress_kbit = max(0, config.get("client_ingress_kbit", 0))
+        Server.egress_kbit = max(0, config.get("client_egress_kbit", 0))
+        Server.burst_kb = max(1, config.get("client_burst_kb", DEFAULT_BURST_KB))
+        Server.handshakes = HandshakePool(config.get("handshake_workers", HANDSHAKE_WORKERS),
+                                          max(0, config.get("handshake_queue", HANDSHAKE_QUEUE)))
+
+    @staticmethod
+    def _on_client(conn, addr, hello):
+        """ Called from the accept loop for every authenticated client """
+        reason = Server.admission.acquire()
+        if reason is not None:
+            Terminal.warn(f"Rejected client {addr[0]}: {reason}")
+            send_auth_fail(conn, reason)
+            conn.close()
+            return
+
+        # Clients identify themselves with a persistent client_id, older ones fall back to their LAN address.
+        # Anyone can claim an id, its lease (and a live session on it) is only taken over with a resume token
+        client_id = str(hello.get("client_id") or addr[0])
+        identity, ip = Server.pool.acquire(client_id, proven=hello.get("resumed", False))
+        if ip is None:
+            Server.admission.release()
+            send_auth_fail(conn, "no free tunnel addresses")
+            conn.close()
+            return
+        negotiated = negotiate(hello, Server.mtu, Server.compression)
+        session = Session(ip, conn, addr, hello.get("name", ""), identity, Server.queue_bytes, negotiated["mtu"],
+                          Server.ring)
+        session.compressor = make_compressor(negotiated["compression"], negotiated["mtu"])
+        session.pinger = Pinger(Server.ping_interval, Server.dead_peer_pings)
+        session.ingress = make_bucket(Server.ingress_kbit, Server.burst_kb)
+        session.egress = make_bucket(Server.egress_kbit, Server.burst_kb)
+        previous = Server.sessions.add(session)
+        if previous is not None:
+            # Same client reconnected before its old connection was noticed dead
+            Server.admission.release()
+            Server._drop_session(previous)
+
+        details = {"ip": ip, "netmask": Server.netmask, "server_ip": Server.server_ip, **negotiated}
+        if hello.get("client_id") and identity == client_id:
+            details.update(token=Authentication.issue_token(client_id, Server.token_ttl), token_ttl=Server.token_ttl)
+        try:
+            send_auth_ok(conn, **details)
+        except OSError:
+            Server._on_session_closed(session)
+            return
+
+        Terminal.success(f"Client {addr[0]} connected as {ip}")
+        Audit.record(CONNECT, a=ip, b=addr[0], port_b=addr[1])
+        Server.save_status()
+        if Server.engine is not None:
+            Server.engine.loop.call_soon_threadsafe(Server.engine.add_session, session, Server.tun_fd,
+                                                    Server._on_session_closed, Server._on_control, Server.packet_filter,
+                                                    Server.flows)
+        else:
+            threading.Thread(target=session.writer_loop, daemon=True).start()
+            threading.Thread(target=Server._run_session, args=(session,), daemon=True).start()
+
+    @staticmethod
+    def _drop_session(session, reason="replaced by a new connection"):
+        """ Close a session from outside the data plane, the asyncio engine has to do it on its own loop """
+        if session.channel is not None and Server.engine is not None:
+            def close():
+                session.channel.close(reason)
+                session.close()
+            Server.engine.loop.call_soon_threadsafe(close)
+        else:
+            session.close()
+
+    @staticmethod
+    def _on_control(session, payload):
+        """ Control frames from a client, pings are answered so it can measure RTT and knows we are alive """
+        reply = session.pinger.on_control(payload)
+        if reply is not None:
+            Server._send_control(session, reply)
+
+    @staticmethod
+    def _send_control(session, payload):
+        """ Thread safe, the asyncio engine sends from its own loop """
+        if Server.engine is not None:
+            if session.channel is not None:
+                try:
+                    Server.engine.loop.call_soon_threadsafe(session.channel.send_control, payload)
+                except RuntimeError:
+                    pass  # loop already closed
+            return
+        try:
+            session.send(encode_frame(FRAME_CONTROL, payload))
+        except OSError:
+            pass  # the reader notices the dead connection
+
+    @staticmethod
+    def _ping_sessions(stop):
+        """ Ping every client, the ones that stop answering are disconnected (see Pinger) """
+        while not stop.wait(PING_TICK):
+            for session in Server.sessions:
+                if session.pinger is None or session.closed:
+                    continue
+                payload = session.pinger.poll()
+                if session.pinger.dead:
+                    Terminal.warn(f"Client {session.ip} stopped answering pings, disconnecting")
+                    Server._drop_session(session, "client stopped answering pings")
+                elif payload is not None:
+                    Server._send_control(session, payload)
+
+    @staticmethod
+    def _run_session(session):
+        try:
+            session_to_tun(session, Server.tun_queue, Server._on_control, packet_filter=Server.packet_filter,
+                           flows=Server.flows)
+        finally:
+            Server._on_session_closed(session)
+
+    @staticmethod
+    def _on_session_closed(session):
+        if Server.tun_queue is not None:
+            Server.tun_queue.remove(session)
+        if Server.sessions.remove(session):
+            Server.admission.release()
+            Server.pool.release(session.client_id)
+            Terminal.log(f"Client {session.ip} disconnected")
+            Audit.record(DISCONNECT, a=session.ip, b=session.peer[0], port_b=session.peer[1],
+                         count_a=int(time.time() - session.connected_at), count_b=session.blocked)
+            Server.save_status()
+        session.close()
+
+    @staticmethod
+    def serve(tun_fd, listener, ctx):
         """
-        tun = setup_tun_interface("10.8.0.1", "255.255.255.0")
-        conn = start_tls_server(tun)
-        start_forwarding(tun, conn)
-        Status.save_status()
+        Run the data plane until 'diablo stop' (SIGTERM), Ctrl+C or a fatal error.
+        Threads engine: one shared TUN dispatcher plus one reader thread per client.
+        asyncio engine: the TUN device and every client socket on one event loop.
         """
-    
+        config = Settings.values()
+        Server._configure_admission(config)
+        Server.tun_fd = tun_fd
+
+        Terminal.log("[*] Accepting clients. Run 'diablo stop' to shut down.")
+        reason = Server.run_data_plane(
+            [tun_fd], lambda stop: accept_clients(listener, ctx, Server.password_required, Server._on_client, stop,
+                                                  Server.handshakes),
+            config)
+
+        Terminal.write(Terminal.get_color_bold(f"\n[!] Shutting down Diablo server ({reason}).\n", "star"))
+        try:
+            listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        listener.close()
+        Server.close_sessions()
+        os.close(tun_fd)
+        Status.clear_status()
+
+    @staticmethod
+    def run_data_plane(read_fds, accept, config):
+        """
+        Forward until stopped and return the reason. Packets read from every fd in
+        read_fds (TUN queues, multi-queue inboxes) are routed through the session
+        table, accept(stop) hands authenticated clients to _on_client.
+        """
+        max_batch, flush_ms = forwarding_options(config)
+        stop = threading.Event()
+        Audit.start(config, Server.audit_name)
+        Server.packet_filter = PacketFilter(Server.pool.network, Server.firewall)
+        if config.get("monitor_ports", False):
+            Server.flows = FlowTable(max(1, config.get("max_flows", DEFAULT_MAX_FLOWS)),
+                                     config.get("flow_idle_timeout", DEFAULT_IDLE_TIMEOUT))
+            threading.Thread(target=Server.flows.run, args=(stop,), daemon=True).start()
+        if Server.coordinator is None:
+            if Server.firewall is not None:
+                Server.firewall.start_watching(stop)
+            if Server.arp is not None:
+                Server.arp.start_watching(stop)
+        Authentication.start_verify_pool(config.get("auth_processes", AUTH_PROCESSES))
+        threading.Thread(target=Server._refresh_status, args=(stop,), daemon=True).start()
+        threading.Thread(target=Server._ping_sessions, args=(stop,), daemon=True).start()
+        if config.get("data_plane", "threads") == "asyncio":
+            from .async_forwarder import AsyncEngine
+            Server.engine = AsyncEngine(max_batch, Server.queue_bytes, Server.mtu, Server.ring)
+            for fd in read_fds:
+                Server.engine.attach_tun(fd, Server.sessions, Server.packet_filter, Server.flows)
+
+            def accept_then_stop():
+                accept(stop)
+                Server.engine.stop_threadsafe("accept loop exited")
+            threading.Thread(target=accept_then_stop, daemon=True).start()
+            reason = Server.engine.run()
+            stop.set()
+        else:
+            wake_r, wake_w = os.pipe()
+            Server.tun_queue = FairQueue(Server.mtu, Server.queue_bytes)
+            Server.tun_writer = TunWriter(Server.tun_fd)
+            start_worker(Server.tun_queue.run, (Server._write_tun, stop), stop)
+            for fd in read_fds:
+                start_worker(tun_dispatch, (fd, Server.sessions, Server.ring, max_batch, flush_ms, Server.mtu, stop,
+                                          wake_r, Server.packet_filter, Server.flows), stop)
+            start_worker(accept, (stop,), stop)
+            reason = wait_for_shutdown(stop)
+            os.write(wake_w, b"\0")
+        Server.handshakes.shutdown()
+        Authentication.stop_verify_pool()
+        Audit.stop()
+        return reason
+
+    @staticmethod
+    def _write_tun(packet):
+        try:
+            Server.tun_writer.write(packet)
+        except OSError as e:
+            Terminal.warn(f"TUN write failed: {e}")
+
+    @staticmethod
+    def _refresh_status(stop):
+        """ Counters like the handshake queue change between connects, republish them every few seconds """
+        while not stop.wait(STATUS_INTERVAL):
+            Server.save_status()
+
+    @staticmethod
+    def close_sessions():
+        for session in Server.sessions:
+            Server.sessions.remove(session)
+            session.close()
+
     @staticmethod
     def stop_server(): 
         """ Aqcuires running server info from server json, if it exists, otherwise exits """
@@ -0,0 +1,231 @@
+import time
+import socket
+import struct
+import threading
+import ipaddress
+from collections import deque
+from .tun import DEFAULT_MTU
+from .buffers import BufferRing
+
+IPV4_ADDRESS = struct.Struct("!I")
+IPV4_SRC_OFFSET = 12
+IPV4_DST_OFFSET = 16
+IPV4_MIN_HEADER = 20
+
+DEFAULT_QUEUE_BYTES = 256 * 1024
+ADMISSION_WAIT = 30
+
+def packet_source(packet):
+    """ Source address of an IPv4 packet as an int, None for anything else """
+    if len(packet) < IPV4_MIN_HEADER or packet[0] >> 4 != 4:
+        return None
+    return IPV4_ADDRESS.unpack_from(packet, IPV4_SRC_OFFSET)[0]
+
+def packet_destination(packet):
+    """ Destination address of an IPv4 packet as an int, None for anything else """
+    if len(packet) < IPV4_MIN_HEADER or packet[0] >> 4 != 4:
+        return None
+    return IPV4_ADDRESS.unpack_from(packet, IPV4_DST_OFFSET)[0]
+
+
+class Session:
+    """
+    One authenticated client: its TLS connection and the tunnel IP it was given.
+    Packets from the shared TUN reader go through a bounded send queue drained
+    by the client's own writer thread, so a slow client only ever costs up to
+    high_watermark bytes and never blocks the TUN reader. Once the queue hits
+    the high watermark packets for this client are dropped until it drains
+    below the low watermark. Queued data lives in buffers borrowed from ring
+    and goes back to it once sent or dropped. compressor is set when the
+    handshake negotiated compression for this client, ingress / egress are
+    its token buckets when it is rate limited (see shaping.py).
+    """
+
+    __slots__ = ("ip", "address", "conn", "peer", "name", "client_id", "mtu", "connected_at", "send_lock", "channel",
+                 "compressor", "pinger", "ingress", "egress", "ring", "queue", "queued_bytes", "high_watermark", "low_watermark", "congested", "dropped",
+                 "blocked", "closed", "_ready")
+
+    def __init__(self, ip, conn, peer, name="", client_id=None, queue_bytes=DEFAULT_QUEUE_BYTES, mtu=DEFAULT_MTU,
+                 ring=None):
+        self.ip = str(ip)
+        self.address = int(ipaddress.IPv4Address(self.ip))
+        self.conn = conn
+        self.peer = peer
+        self.name = name
+        self.client_id = client_id
+        self.mtu = mtu
+        self.connected_at = time.time()
+        self.send_lock = threading.Lock()
+        self.channel = None  # AsyncConnection when the asyncio data plane owns this session
+        self.compressor = None
+        self.pinger = None
+        self.ingress = None
+        self.egress = None
+        self.ring = ring if ring is not None else BufferRing()
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.high_watermark = queue_bytes
+        self.low_watermark = queue_bytes // 4
+        self.congested = False
+        self.dropped = 0
+        self.blocked = 0    # packets dropped by the port filter
+        self.closed = False
+        self._ready = threading.Condition()
+
+    def send(self, data):
+        """ Thread safe sendall, frames from different threads never interleave """
+        with self.send_lock:
+            self.conn.sendall(data)
+
+    def enqueue(self, buffer):
+        """
+        Non-blocking, called by the shared TUN reader with a filled ring buffer
+        the session takes ownership of. Returns False if it was dropped.
+        """
+        with self._ready:
+            if not self.closed:
+                if self.congested and self.queued_bytes <= self.low_watermark:
+                    self.congested = False
+                elif not self.congested and self.queued_bytes >= self.high_watermark:
+                    self.congested = True
+                if not self.congested:
+                    self.queue.append(buffer)
+                    self.queued_bytes += buffer.pending
+                    self._ready.notify()
+                    return True
+                self.dropped += 1
+        self.ring.release(buffer)
+        return False
+
+    def writer_loop(self):
+        """ Drain the send queue into the TLS socket straight from the ring buffers """
+        while True:
+            with self._ready:
+                while not self.queue and not self.closed:
+                    self._ready.wait()
+                if self.closed:
+                    return
+                buffer = self.queue.popleft()
+            try:
+                self.send(buffer.view[buffer.start:buffer.end])
+            except OSError:
+                return  # the reader side notices the dead connection and cleans up
+            finally:
+                with self._ready:
+                    if not self.closed:  # close() already zeroed the count
+                        self.queued_bytes -= buffer.pending
+                self.ring.release(buffer)
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            while self.queue:
+                self.ring.release(self.queue.popleft())
+            self.queued_bytes = 0
+            self._ready.notify_all()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def info(self):
+        """ Summary saved to status.json for 'diablo status' """
+        return {
+            "ip": self.ip,
+            "peer": f"{self.peer[0]}:{self.peer[1]}" if self.peer else "",
+            "name": self.name,
+            "mtu": self.mtu,
+            "connected_at": int(self.connected_at),
+            "dropped": self.dropped,
+            "blocked": self.blocked,
+            "compression": self.compressor.stats() if self.compressor is not None else None,
+            **(self.pinger.stats() if self.pinger is not None else {}),
+        }
+
+
+class Admission:
+    """
+    Admission control for new clients. At most max_clients sessions (None for
+    unlimited); past the limit up to max_pending clients wait for a free slot,
+    anyone beyond that is turned away.
+    """
+
+    def __init__(self, max_clients=None, max_pending=0, accepting=True, wait=ADMISSION_WAIT):
+        self.max_clients = max_clients
+        self.max_pending = max_pending
+        self.accepting = accepting
+        self.wait = wait
+        self.active = 0
+        self.pending = 0
+        self._slots = threading.Condition()
+
+    def _has_slot(self):
+        return self.max_clients is None or self.active < self.max_clients
+
+    def acquire(self):
+        """ Blocks while queued. Returns None once admitted, otherwise the reason for rejection """
+        with self._slots:
+            if not self.accepting:
+                return "server is not accepting new connections"
+            if not self._has_slot():
+                if self.pending >= self.max_pending:
+                    return "server is full"
+                self.pending += 1
+                try:
+                    if not self._slots.wait_for(self._has_slot, timeout=self.wait):
+                        return "server is full"
+                finally:
+                    self.pending -= 1
+            self.active += 1
+            return None
+
+    def release(self):
+        with self._slots:
+            self.active -= 1
+            self._slots.notify()
+
+
+class SessionTable:
+    """
+    Active sessions keyed by tunnel address (as an int), so the TUN reader can
+    route a packet to its client with a single dict lookup on the destination.
+    Reads don't take the lock, dict lookups are atomic under the GIL.
+    """
+
+    def __init__(self):
+        self._by_address = {}
+        self._lock = threading.Lock()
+
+    def add(self, session):
+        with self._lock:
+            previous = self._by_address.get(session.address)
+            self._by_address[session.address] = session
+        return previous
+
+    def remove(self, session):
+        """ Remove session, unless its address has already been handed to a newer session """
+        with self._lock:
+            if self._by_address.get(session.address) is session:
+                del self._by_address[session.address]
+                return True
+        return False
+
+    def get(self, address):
+        return self._by_address.get(address)
+
+    def route(self, packet):
+        """ Session that owns the destination address of packet, or None """
+        destination = packet_destination(packet)
+        if destination is None:
+            return None
+        return self._by_address.get(destination)
+
+    def in_use(self, ip):
+        return int(ipaddress.IPv4Address(str(ip))) in self._by_address
+
+    def __len__(self):
+        return len(self._by_address)
+
+    def __iter__(self):
+        return iter(list(self._by_address.values()))
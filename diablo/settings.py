@@ -1,6 +1,9 @@
 import json
 import os
+import copy
+import time
 import platform
+import threading
 from textwrap import dedent
 from pathlib import Path
 from importlib.resources import files
@@ -49,10 +52,36 @@ class Settings:
         "name": "_.TEXT",
         "log_level": ["debug", "info", "warning", "error"],
         "default_server_ip": ["._DEFAULT:10.8.0.1", "._TEXT_IP_ADDRESS"],
+        "tunnel_subnet": "_.TEXT",
+        "tunnel_mtu": "_.TEXT_INT",
         "max_clients": ["._DEFAULT:Unlimited", "._TEXT_INT"],
+        "max_pending_clients": "_.TEXT_INT",
+        "client_queue_kb": "_.TEXT_INT",
+        "client_ingress_kbit": "_.TEXT_INT",
+        "client_egress_kbit": "_.TEXT_INT",
+        "client_burst_kb": "_.TEXT_INT",
         "filtered_ports" : "_.LIST_PORT",
         "blocked_ports": "_.LIST_PORT",   
-        "bind_interface": ["tun0"],
+        "max_flows": "_.TEXT_INT",
+        "flow_idle_timeout": "_.TEXT_INT",
+        "bind_interface": "_.TEXT",
+        "audit_segment_mb": "_.TEXT_INT",
+        "audit_max_segments": "_.TEXT_INT",
+        "batch_max_packets": "_.TEXT_INT",
+        "batch_flush_ms": "_.TEXT_INT",
+        "data_plane": ["threads", "asyncio"],
+        "tun_queues": "_.TEXT_INT",
+        "tls_ticket_rotation_minutes": "_.TEXT_INT",
+        "auth_token_ttl": "_.TEXT_INT",
+        "handshake_workers": "_.TEXT_INT",
+        "handshake_queue": "_.TEXT_INT",
+        "auth_processes": "_.TEXT_INT",
+        "cert_key_type": ["ecdsa-p256", "ed25519", "rsa-2048"],
+        "cert_rotation_days": "_.TEXT_INT",
+        "compression": ["off", "zlib", "lz4"],
+        "keepalive_interval": "_.TEXT_INT",
+        "dead_peer_pings": "_.TEXT_INT",
+        "reconnect_max_delay": "_.TEXT_INT",
     }
     
     """ Windows for future development >:() """
@@ -62,25 +91,142 @@ class Settings:
         CONFIG_DIR = Path.home() / ".config" / "diablo"
 
     CONFIG_PATH = CONFIG_DIR / "config.json"
+    CERTS_DIR = CONFIG_DIR / "certs"    # server certificate, the same whatever directory diablo runs from
     DEFAULT_CONFIG_PATH = files("diablo.defaults").joinpath("config.json")
 
+    """
+    Process wide cache of config.json. The file is only parsed again when its
+    inode, mtime or size changes, and that is checked at most once every
+    CACHE_CHECK_INTERVAL seconds, so hot paths (per-client auth, packet
+    filtering) reading Settings.get never touch the filesystem. Each parse
+    keeps the raw config for load_config and a validated copy for get, where
+    values of the wrong type are replaced by their default.
+    """
+    CACHE_CHECK_INTERVAL = 1.0
+    _raw = None
+    _values = None
+    _stamp = None
+    _bad_stamp = None   # stamp of a config.json that didn't parse, so it is warned about once
+    _checked = 0.0
+    _defaults = None
+    _cache_lock = threading.Lock()
+
     @staticmethod
     def _ensure_config_exists():
         if not Settings.CONFIG_PATH.exists():
-            Settings.CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-            with open(Settings.DEFAULT_CONFIG_PATH, "r") as f_default, open(Settings.CONFIG_PATH, "w") as f_target:
-                f_target.write(f_default.read()) 
+            Settings._write_defaults()
+
+    @staticmethod
+    def _write_defaults():
+        """ Replace config.json with the defaults through a temp file, like save_config """
+        Settings.CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = Settings.CONFIG_PATH.with_suffix(".tmp")
+        with open(Settings.DEFAULT_CONFIG_PATH, "r") as f_default, open(tmp, "w") as f_target:
+            f_target.write(f_default.read())
+        os.replace(tmp, Settings.CONFIG_PATH)
+
+    @staticmethod
+    def _file_stamp():
+        st = os.stat(Settings.CONFIG_PATH)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def _refresh():
+        """ Re-read config.json if it changed since the last check, throttled to CACHE_CHECK_INTERVAL """
+        now = time.monotonic()
+        if Settings._values is not None and now - Settings._checked < Settings.CACHE_CHECK_INTERVAL:
+            return
+        with Settings._cache_lock:
+            if Settings._values is not None and now - Settings._checked < Settings.CACHE_CHECK_INTERVAL:
+                return
+            stamp = None
+            try:
+                Settings._ensure_config_exists()
+                stamp = Settings._file_stamp()
+                if stamp != Settings._stamp or Settings._values is None:
+                    with open(Settings.CONFIG_PATH, "r") as f:
+                        raw = json.load(f)
+                    if not isinstance(raw, dict):
+                        raise ValueError("not a JSON object")
+                    Settings._values = Settings._validated(raw)
+                    Settings._raw = raw
+                    Settings._stamp = stamp
+            except (OSError, ValueError) as e:
+                # Keep serving the last good config, _stamp is left alone so the file is read again
+                if stamp is None or stamp != Settings._bad_stamp:
+                    Settings._bad_stamp = stamp
+                    Terminal.warn(f"Could not read {Settings.CONFIG_PATH} ({e}), using the "
+                                  f"{'last good' if Settings._values is not None else 'default'} config")
+                if Settings._values is None:
+                    Settings._values = Settings._validated({})
+                    Settings._raw = copy.deepcopy(Settings._defaults)
+            Settings._checked = now
+
+    @staticmethod
+    def invalidate_cache():
+        with Settings._cache_lock:
+            Settings._values = None
+
+    @staticmethod
+    def _validated(raw):
+        """ Copy of raw where every known option has a value of its declared type """
+        if Settings._defaults is None:
+            with open(Settings.DEFAULT_CONFIG_PATH, "r") as f:
+                Settings._defaults = json.load(f)
+        values = dict(Settings._defaults)
+        for key, value in raw.items():
+            if key in Settings._defaults and not Settings._valid_value(key, value):
+                Terminal.warn(f"Invalid value {value!r} for '{key}' in config.json, using the default")
+                continue
+            values[key] = value
+        return values
+
+    @staticmethod
+    def _valid_value(key, value):
+        rule = Settings.none_bool_options.get(key)
+        if rule is None:
+            return isinstance(value, bool)
+        if not isinstance(rule, list):
+            return Settings._validate_choice(value, rule)
+        for choice in rule:
+            if choice.startswith("._DEFAULT:"):
+                if isinstance(value, str) and value.lower() == choice[len("._DEFAULT:"):].lower():
+                    return True
+            elif choice.startswith("._TEXT"):
+                if Settings._validate_choice(value, "_." + choice[2:]):
+                    return True
+            elif value == choice:
+                return True
+        return False
+
+    @staticmethod
+    def get(key, default=None):
+        """ Validated value of a config option, served from the cache """
+        Settings._refresh()
+        return Settings._values.get(key, default)
+
+    @staticmethod
+    def values():
+        """ Validated snapshot of every option, shared between callers so read it, don't modify it """
+        Settings._refresh()
+        return Settings._values
 
     @staticmethod
     def load_config():
-        Settings._ensure_config_exists()
-        with open(Settings.CONFIG_PATH, "r") as f:
-            return json.load(f)
+        """ The whole config as written in config.json, a copy the caller is free to modify """
+        Settings._refresh()
+        return copy.deepcopy(Settings._raw)
         
     @staticmethod
     def save_config(config: dict):
-        with open(Settings.CONFIG_PATH, "w") as f:
+        # Written to a temp file and renamed, readers never see half a file and the inode change
+        # invalidates the cache in every other process
+        Settings.CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = Settings.CONFIG_PATH.with_suffix(".tmp")
+        with open(tmp, "w") as f:
             json.dump(config, f, indent=4)
+        os.replace(tmp, Settings.CONFIG_PATH)
+        Settings.invalidate_cache()
 
     @staticmethod
     def update_config(new_values: dict):
@@ -92,9 +238,7 @@ class Settings:
     def validate_config():
         """ Basic corruption check of config file """
         if not Settings.CONFIG_PATH.exists():
-            Settings.CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-            with open(Settings.DEFAULT_CONFIG_PATH, "r") as f_default, open(Settings.CONFIG_PATH, "w") as f_target:
-                f_target.write(f_default.read()) 
+            Settings._write_defaults()
         
         with open(Settings.DEFAULT_CONFIG_PATH) as f:
             default_config = json.load(f)
@@ -124,15 +268,15 @@ class Settings:
         for key in current_config:
             if not key in default_config:
                 Terminal.warn(Settings.developer_warning)
-                with open(Settings.DEFAULT_CONFIG_PATH, "r") as f_default, open(Settings.CONFIG_PATH, "w") as f_target: 
-                    f_target.write(f_default.read())
+                Settings._write_defaults()
+                Settings.invalidate_cache()
 
     @staticmethod 
     def _validate_choice(choice, possible_choice):
         if possible_choice.startswith("_.TEXT"):
             text_rule = possible_choice
             if text_rule == "_.TEXT_INT":
-                if not isinstance(choice, int):
+                if not isinstance(choice, int) or isinstance(choice, bool):  # bool is a subclass of int
                     return False
             elif text_rule == "_.TEXT_FLOAT":
                 if not isinstance(choice, float):
@@ -145,15 +289,19 @@ class Settings:
             if choice:
                 if text_rule == "_.LIST_INT":
                     for c in choice:
-                        if not isinstance(c, int):
+                        if not isinstance(c, int) or isinstance(c, bool):
                             return False
                 elif text_rule == "_.LIST_FLOAT":
                     for c in choice:
                         if not isinstance(c, float):
                             return False    
+                elif text_rule.startswith("_.LIST_PORT"):
+                    for c in choice:
+                        if not isinstance(c, int) or isinstance(c, bool) or not 0 <= c <= 65535:
+                            return False
                 else: 
                     for c in choice:
-                        if not isinstance(choice, str):
+                        if not isinstance(c, str):
                             return False
 
         return True               
@@ -191,8 +339,8 @@ class Settings:
         if not is_yes:
             return 
         
-        with open(Settings.DEFAULT_CONFIG_PATH, "r") as f_default, open(Settings.CONFIG_PATH, "w") as f_target: 
-            f_target.write(f_default.read())
+        Settings._write_defaults()
+        Settings.invalidate_cache()
 
         Terminal.newline()
         Terminal.success("Restored settings to default")
@@ -0,0 +1,180 @@
+"""
+Per-client traffic shaping on the server. Every session can have a token
+bucket for ingress (client -> server) and egress (server -> client), set
+with "client_ingress_kbit" / "client_egress_kbit" in config.json (0 for
+unlimited). Packets from all clients to the shared TUN device go through a
+FairQueue, so a client pushing a bulk upload only delays its own packets.
+"""
+import time
+import threading
+from collections import deque
+from .tun import DEFAULT_MTU
+from .buffers import Buffer, BufferRing
+
+DEFAULT_BURST_KB = 64
+MIN_BURST = 16 * 1024
+DEFAULT_QUEUE_BYTES = 256 * 1024
+WRITER_WAKEUP = 0.5
+MAX_PACKET_BUFFERS = 8192   # packets queued for the TUN device across every session
+
+class TokenBucket:
+    """
+    rate bytes per second, with up to burst bytes saved up while idle. Not
+    locked, the occasional lost update between two threads only makes it a
+    little generous.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def allow(self, size):
+        """ Policing: take size tokens if there are enough, False (drop the packet) if not """
+        self._refill(time.monotonic())
+        if self.tokens < size:
+            return False
+        self.tokens -= size
+        return True
+
+    def charge(self, size):
+        """ Shaping: always take size tokens, returns how long to pause until the bucket is out of debt """
+        self._refill(time.monotonic())
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+def make_bucket(kbit, burst_kb=DEFAULT_BURST_KB):
+    """ TokenBucket for a limit in kbit/s, None for 0 (unlimited) """
+    if not kbit or kbit <= 0:
+        return None
+    return TokenBucket(kbit * 125, max(MIN_BURST, burst_kb * 1024))
+
+
+class FairQueue:
+    """
+    Deficit round robin over per-session packet queues. Each turn a session
+    with packets waiting gets quantum bytes of credit and sends packets while
+    its credit covers the next one; what's left carries over to its next turn
+    while it stays busy. With quantum >= MTU every busy session sends at
+    least one packet per round, so a client that sends one small packet now
+    and then waits behind at most one packet per other client instead of
+    behind someone's whole burst. Each session may have max_bytes queued.
+
+    Packets are copied into MTU sized buffers from a BufferRing and the
+    buffers are recycled once written, so the callers can pass views of
+    their read buffers and queueing allocates nothing once the pool is warm.
+    """
+
+    def __init__(self, quantum=DEFAULT_MTU, max_bytes=DEFAULT_QUEUE_BYTES, max_buffers=MAX_PACKET_BUFFERS):
+        self.quantum = quantum
+        self.max_bytes = max_bytes
+        self.ring = BufferRing(quantum, max_buffers)
+        self.queues = {}        # session -> deque of Buffers, one packet each
+        self.queued = {}        # session -> bytes queued
+        self.deficit = {}
+        self.active = deque()   # sessions with packets, in round robin order
+        self.in_turn = False    # active[0] already got its quantum this round
+        self._ready = threading.Condition()
+
+    def _has_room(self, session, size):
+        """ Caller holds the lock """
+        ring = self.ring
+        return self.queued.get(session, 0) + size <= self.max_bytes and (
+            ring.free or ring.allocated < ring.max_buffers or size > ring.size)
+
+    def put(self, session, packet, timeout=None):
+        """
+        Queue a copy of packet for session. With a timeout, wait up to that
+        long for room (a reader thread blocks and TCP pushes back on the
+        client), otherwise return False straight away when the session's
+        queue is full.
+        """
+        size = len(packet)
+        with self._ready:
+            if not self._has_room(session, size):
+                if not timeout or not self._ready.wait_for(lambda: self._has_room(session, size), timeout):
+                    return False
+            # Larger than the MTU can only come from a misbehaving peer, copied without the pool
+            buffer = self.ring.acquire() if size <= self.ring.size else Buffer(size)
+            buffer.append(packet)
+            queue = self.queues.get(session)
+            if queue is None:
+                queue = self.queues[session] = deque()
+                self.deficit[session] = 0
+            if not queue:
+                self.active.append(session)
+            queue.append(buffer)
+            self.queued[session] = self.queued.get(session, 0) + size
+            self._ready.notify_all()
+            return True
+
+    def _recycle(self, buffer):
+        if len(buffer.data) == self.ring.size:
+            self.ring.release(buffer)
+
+    def remove(self, session):
+        """ Forget a closed session and anything it still had queued """
+        with self._ready:
+            queue = self.queues.pop(session, None)
+            if queue:
+                if self.active and self.active[0] is session:
+                    self.in_turn = False
+                self.active.remove(session)
+                for buffer in queue:
+                    self._recycle(buffer)
+            self.queued.pop(session, None)
+            self.deficit.pop(session, None)
+            self._ready.notify_all()
+
+    def _pop(self):
+        """ Buffer of the next packet in DRR order, None when every queue is empty. Caller holds the lock """
+        while self.active:
+            session = self.active[0]
+            queue = self.queues[session]
+            if not self.in_turn:
+                self.deficit[session] += self.quantum
+                self.in_turn = True
+            if queue[0].end <= self.deficit[session]:
+                buffer = queue.popleft()
+                self.deficit[session] -= buffer.end
+                self.queued[session] -= buffer.end
+                if not queue:
+                    self.active.popleft()
+                    self.deficit[session] = 0
+                    self.in_turn = False
+                return buffer
+            self.active.rotate(-1)
+            self.in_turn = False
+        return None
+
+    def drain(self, write):
+        """ write() every queued packet in DRR order, for the asyncio engine's loop thread """
+        count = 0
+        while True:
+            with self._ready:
+                buffer = self._pop()
+                if buffer is None:
+                    self._ready.notify_all()
+                    return count
+            write(buffer.view[:buffer.end])
+            self._recycle(buffer)
+            count += 1
+
+    def run(self, write, stop):
+        """ Writer thread for the threads engine, write() is called outside the lock """
+        while not stop.is_set():
+            with self._ready:
+                buffer = self._pop()
+                if buffer is None:
+                    self._ready.wait(WRITER_WAKEUP)
+                    continue
+                self._ready.notify_all()
+            write(buffer.view[:buffer.end])
+            self._recycle(buffer)
@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import platform
 import ctypes
 from pathlib import Path
@@ -24,8 +25,11 @@ class Status:
     def save_status(data):
         """Save current session status."""
         os.makedirs(STATUS_FILE.parent, exist_ok=True)
-        with open(STATUS_FILE, "w") as f:
+        # Written to a temp file and renamed so 'diablo status' never reads half a file
+        tmp = STATUS_FILE.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
             json.dump(data, f, indent=2)
+        os.replace(tmp, STATUS_FILE)
 
     @staticmethod
     def clear_status():
@@ -56,6 +60,75 @@ class Status:
             
         return False, None
     
+    @staticmethod
+    def print_status():
+        """ 'diablo status', summary of the running server or connection """
+        active, status = Status.is_session_active()
+        if not active:
+            Terminal.quick_message("No active Diablo session")
+            return
+
+        Terminal.print(f"Diablo {status.get('mode', '')} (pid {status.get('pid')})", color_bold="star")
+        if status.get("mode") == "client":
+            Terminal.print(f"Server: {status.get('server')} ({status.get('state', '?')})", bold=True)
+            Terminal.print(f"Tunnel address: {status.get('tunnel_ip') or '-'}, "
+                           f"reconnects: {status.get('reconnects', 0)}")
+            Status.print_arp(status.get("arp"))
+            return
+        if status.get("server_ip"):
+            Terminal.print(f"Tunnel address: {status['server_ip']}", bold=True)
+        clients = status.get("clients", [])
+        Terminal.print(f"Connected clients: {len(clients)}", bold=True)
+        now = time.time()
+        for client in clients:
+            minutes = int(now - client.get("connected_at", now)) // 60
+            name = f" ({client['name']})" if client.get("name") else ""
+            rtt = client.get("rtt_ms")
+            latency = (f", rtt {rtt} ms ± {client.get('jitter_ms', 0)} ms, {client.get('lost_pings', 0)} pings lost"
+                       if rtt is not None else "")
+            Terminal.print(f"  {client.get('ip', '?'):<15} {client.get('peer', ''):<21}{name} "
+                           f"up {minutes}m, mtu {client.get('mtu', '?')}, dropped {client.get('dropped', 0)}, "
+                           f"blocked {client.get('blocked', 0)}{latency}")
+            compression = client.get("compression")
+            if compression:
+                ratio = f"{compression['ratio']:.0%}" if compression.get("ratio") else "-"
+                Terminal.print(f"  {'':<15} {compression['method']}: {compression['compressed']} packets "
+                               f"compressed to {ratio}, {compression['bypassed']} bypassed, "
+                               f"{compression['saved_bytes'] // 1024} KiB saved, {compression['cpu_ms']} ms CPU")
+        handshakes = status.get("handshakes")
+        if handshakes:
+            Terminal.print(f"Handshakes: {handshakes.get('queued', 0)} queued, {handshakes.get('active', 0)} active, "
+                           f"{handshakes.get('rejected', 0)} rejected, {handshakes.get('completed', 0)} completed")
+        blocked_ports = status.get("blocked_ports")
+        if blocked_ports:
+            Terminal.print("Blocked ports: " + ", ".join(f"{port} ({count})" for port, count in blocked_ports.items()))
+        if status.get("tun_dropped"):
+            Terminal.print(f"TUN device full: {status['tun_dropped']} packets dropped")
+        Status.print_arp(status.get("arp"))
+        flows = status.get("flows")
+        if flows:
+            Terminal.print(f"Flows: {flows['active']} active, {flows['expired']} expired, "
+                           f"{flows['untracked']} packets untracked")
+            for flow in flows.get("top", []):
+                Terminal.print(f"  {flow['protocol']:<4} {flow['client']:<21} -> {flow['remote']:<27} "
+                               f"{flow['sent'] // 1024} KiB up, {flow['received'] // 1024} KiB down, "
+                               f"{flow['packets']} packets")
+        audit = status.get("audit")
+        if audit:
+            Terminal.print(f"Audit log: {audit['written']} records written, {audit['pending']} pending, "
+                           f"{audit['dropped']} dropped, segment {audit['segment']}")
+
+    @staticmethod
+    def print_arp(arp):
+        """ ARP watcher summary, see arp.py """
+        if not arp:
+            return
+        Terminal.print(f"ARP on {arp['interface']}: {arp['hosts']} hosts, {arp['conflicts']} conflicts, "
+                       f"{arp['mismatched']} mismatched senders, {arp['dropped']} frames dropped")
+        for conflict in arp.get("recent", []):
+            seen = time.strftime("%H:%M:%S", time.localtime(conflict["at"]))
+            Terminal.print(f"  {seen} {conflict['ip']:<15} {conflict['previous']} -> {conflict['mac']}")
+
     @staticmethod
     def is_root():
         system = platform.system()
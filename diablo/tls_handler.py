@@ -1,30 +1,166 @@
+import os
 import ssl
+import time
 import socket
 import json
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from .terminal import Terminal
 from .settings import Settings
+from .handshake import ServerHandshake, HandshakeError, client_handshake, complete_tls, send_message, TLS_TIMEOUT
 
-CONFIG_DIR = Path.home() / ".config" / "diablo"
-CERTS_DIR = Path(__file__).parent.parent / "certs"
+CONFIG_DIR = Settings.CONFIG_DIR
+CERT_PATH = Settings.CERTS_DIR / "cert.pem"
+KEY_PATH = Settings.CERTS_DIR / "key.pem"
+RESUME_FILE = CONFIG_DIR / "resume.json"
+HANDSHAKE_WORKERS = 4
+HANDSHAKE_QUEUE = 64
+SESSION_TICKETS = 2
+TICKET_ROTATION_MINUTES = 60
 
-def load_config():
-    cfg_file = CONFIG_DIR / "config.json"
-    if cfg_file.exists():
-        return json.loads(cfg_file.read_text())
-    return {}
+CIPHER_BENCHMARK_FILE = CONFIG_DIR / "cipher_benchmark.json"
+CIPHER_SUITES = {"aesgcm": "ECDHE+AESGCM", "chacha20": "ECDHE+CHACHA20"}
+OP_PRIORITIZE_CHACHA = 0x00200000  # OpenSSL option the ssl module doesn't export
+_preferred_cipher = None
 
-def start_tls_server(bind_addr="0.0.0.0", port=4433, backlog=5):
-    cfg = Settings.load_config()
-    password_required = cfg.get("require_password", False)
-    password = cfg.get("password", None)
+def has_aes_acceleration():
+    """ AES-NI on x86 or the AES extension on ARM. Assumed present if the CPU can't be inspected """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return "aes" in line.split(":", 1)[1].split()
+    except OSError:
+        pass
+    return True
+
+def _measure_cipher(ciphers, megabytes=8):
+    """ MB/s of TLS 1.2 bulk encryption plus decryption with ciphers, both ends in memory """
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(certfile=str(CERT_PATH), keyfile=str(KEY_PATH))
+    client_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_ctx.check_hostname = False
+    client_ctx.verify_mode = ssl.CERT_NONE
+    for ctx in (server_ctx, client_ctx):
+        ctx.maximum_version = ssl.TLSVersion.TLSv1_2  # TLS 1.3 suites can't be restricted from Python
+        ctx.set_ciphers(ciphers)
+
+    client_in, client_out, server_in, server_out = (ssl.MemoryBIO() for _ in range(4))
+    client = client_ctx.wrap_bio(client_in, client_out)
+    server = server_ctx.wrap_bio(server_in, server_out, server_side=True)
+    pending = [client, server]
+    for _ in range(10):
+        for end in list(pending):
+            try:
+                end.do_handshake()
+                pending.remove(end)
+            except ssl.SSLWantReadError:
+                pass
+        server_in.write(client_out.read())
+        client_in.write(server_out.read())
+        if not pending:
+            break
+    else:
+        raise ssl.SSLError(f"benchmark handshake for {ciphers} did not complete")
+
+    record = bytes(16 * 1024)
+    started = time.perf_counter()
+    for _ in range(megabytes * 64):
+        client.write(record)
+        server_in.write(client_out.read())
+        while True:
+            try:
+                server.read(len(record))
+            except ssl.SSLWantReadError:
+                break
+    return megabytes / (time.perf_counter() - started)
+
+def benchmark_ciphers():
+    """ Measure AES-GCM against ChaCha20-Poly1305 on this host, kept in cipher_benchmark.json for later starts """
+    results = {}
+    for name, ciphers in CIPHER_SUITES.items():
+        try:
+            results[name] = round(_measure_cipher(ciphers), 1)
+        except ssl.SSLError as e:
+            Terminal.warn(f"Could not benchmark {name}: {e}")
+    os.makedirs(CIPHER_BENCHMARK_FILE.parent, exist_ok=True)
+    with open(CIPHER_BENCHMARK_FILE, "w") as f:
+        json.dump(results, f, indent=2)
+    Terminal.log("Cipher benchmark: " + ", ".join(f"{name} {speed} MB/s" for name, speed in results.items()))
+    return results
 
-    # SSL context
+def preferred_cipher():
+    """ "aesgcm" or "chacha20": the benchmark winner if there is one, otherwise AES-GCM only with AES hardware """
+    global _preferred_cipher
+    if _preferred_cipher is None:
+        try:
+            with open(CIPHER_BENCHMARK_FILE, "r") as f:
+                results = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            results = {}
+        if len(results) == len(CIPHER_SUITES):
+            _preferred_cipher = max(results, key=results.get)
+        else:
+            _preferred_cipher = "aesgcm" if has_aes_acceleration() else "chacha20"
+    return _preferred_cipher
+
+def build_server_context():
+    """
+    SSL context from the files generate_self_signed_cert writes, issuing TLS 1.3
+    session tickets. TLS 1.2 is restricted to ECDHE with AES-GCM or ChaCha20,
+    the faster of the two for this host first, and the server's order wins.
+    Python can't reorder TLS 1.3 suites, so there ChaCha20 is only prioritized
+    (for clients that prefer it) when it is the faster one.
+    """
     ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ctx.load_cert_chain(
-        certfile=str(CERTS_DIR / "server.crt"),
-        keyfile=str(CERTS_DIR / "server.key")
+        certfile=str(CERT_PATH),
+        keyfile=str(KEY_PATH)
     )
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    ctx.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    if preferred_cipher() == "chacha20":
+        ctx.set_ciphers(f"{CIPHER_SUITES['chacha20']}:{CIPHER_SUITES['aesgcm']}")
+        ctx.options |= OP_PRIORITIZE_CHACHA
+    else:
+        ctx.set_ciphers(f"{CIPHER_SUITES['aesgcm']}:{CIPHER_SUITES['chacha20']}")
+    ctx.options &= ~ssl.OP_NO_TICKET
+    ctx.num_tickets = SESSION_TICKETS
+    return ctx
+
+class RotatingContext:
+    """
+    Server SSL context that is rebuilt every rotate_minutes. Python has no API
+    for TLS session ticket keys, OpenSSL generates fresh ones for every new
+    context, so rebuilding it is how the ticket key rotates. A ticket from
+    before the rotation simply gets a full handshake. Stands in for the
+    SSLContext wherever the server only needs wrap_socket.
+    """
+
+    def __init__(self, rotate_minutes=TICKET_ROTATION_MINUTES):
+        self.rotate_after = max(1, rotate_minutes) * 60
+        self.ctx = build_server_context()
+        self.created = time.monotonic()
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            if time.monotonic() - self.created > self.rotate_after:
+                self.ctx = build_server_context()
+                self.created = time.monotonic()
+            return self.ctx
+
+    def wrap_socket(self, sock, **kwargs):
+        return self.current().wrap_socket(sock, **kwargs)
+
+def start_tls_server(bind_addr="0.0.0.0", port=4433, backlog=5):
+    cfg = Settings.values()
+    password_required = cfg.get("require_password", False)
+
+    if cfg.get("benchmark_ciphers", False) and not CIPHER_BENCHMARK_FILE.exists():
+        benchmark_ciphers()
+    ctx = RotatingContext(cfg.get("tls_ticket_rotation_minutes", TICKET_ROTATION_MINUTES))
 
     # TCP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -35,30 +171,169 @@ def start_tls_server(bind_addr="0.0.0.0", port=4433, backlog=5):
     Terminal.success(f"TLS server started on {bind_addr}:{port} "
                      f"{'(password protected)' if password_required else ''}")
 
-    return sock, ctx, password_required, password
+    return sock, ctx, password_required
 
-def authenticate_client(conn, password_required, password):
+class HandshakePool:
     """
-    Authenticate client after TLS handshake.
-    Returns True if auth ok, False otherwise.
+    Bounded pool for TLS handshakes and authentication. At most workers run at
+    once (the ssl module releases the GIL while OpenSSL does the handshake,
+    argon2 runs in Authentication's process pool), up to max_queue more wait
+    for a worker and anything beyond that is closed straight away. A reconnect
+    storm costs a bounded amount of CPU and memory and never stalls the data
+    plane. stats() is published in status.json.
     """
-    try:
-        data = conn.recv(1024).decode()
-        msg = json.loads(data)
-
-        if password_required:
-            client_pw = msg.get("auth", {}).get("password", "")
-            if client_pw == password:
-                conn.sendall(json.dumps({"auth": "ok"}).encode())
-                return True
-            else:
-                conn.sendall(json.dumps({"auth": "fail", "reason": "invalid password"}).encode())
+
+    def __init__(self, workers=HANDSHAKE_WORKERS, max_queue=HANDSHAKE_QUEUE):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="handshake")
+        self.max_queue = max_queue
+        self.queued = 0
+        self.active = 0
+        self.rejected = 0
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def submit(self, raw_conn, addr, ctx, password_required, on_client):
+        """ Queue a handshake, False (and the connection closed) if the queue is full """
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raw_conn.close()
                 return False
-        else:
-            # No password required
-            conn.sendall(json.dumps({"auth": "ok"}).encode())
-            return True
+            self.queued += 1
+        self.executor.submit(self._run, raw_conn, addr, ctx, password_required, on_client)
+        return True
 
-    except Exception as e:
-        Terminal.error(f"Auth error: {e}")
-        return False
+    def _run(self, raw_conn, addr, ctx, password_required, on_client):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            handshake_client(raw_conn, addr, ctx, password_required, on_client)
+        except Exception as e:
+            Terminal.error(f"Handshake with {addr[0]} failed: {e}", exit=False)
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    def stats(self):
+        with self._lock:
+            return {"queued": self.queued, "active": self.active, "rejected": self.rejected,
+                    "completed": self.completed}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def accept_clients(sock, ctx, password_required, on_client, stop=None, pool=None):
+    """
+    Accept loop for the listening socket returned by start_tls_server. TLS
+    handshakes and authentication run in a HandshakePool so slow clients can't
+    hold up the others; authenticated clients are handed to
+    on_client(conn, addr, hello).
+    """
+    pool = pool if pool is not None else HandshakePool()
+    while stop is None or not stop.is_set():
+        try:
+            raw_conn, addr = sock.accept()
+        except OSError as e:
+            if stop is None or not stop.is_set():
+                Terminal.error(f"Accept failed: {e}", exit=False)
+            break
+        if not pool.submit(raw_conn, addr, ctx, password_required, on_client):
+            Terminal.warn(f"Handshake queue full, dropped connection from {addr[0]}")
+
+def handshake_client(raw_conn, addr, ctx, password_required, on_client):
+    conn, hello = ServerHandshake(raw_conn, addr, ctx, password_required).run()
+    if conn is not None:
+        on_client(conn, addr, hello)
+
+def send_auth_ok(conn, **details):
+    """ Accept the client, details (tunnel ip, netmask, negotiated parameters, ...) are included in the reply """
+    send_message(conn, {"auth": "ok", **details})
+
+def send_auth_fail(conn, reason):
+    try:
+        send_message(conn, {"auth": "fail", "reason": reason})
+    except (OSError, HandshakeError):
+        pass
+
+
+class SessionStore:
+    """
+    Client side state for fast reconnects, keyed by "host:port". TLS sessions
+    (tickets) are kept in memory and offered on the next handshake so it
+    resumes in one round trip; SSLSession can't be serialized, so they only
+    last as long as the client process. Resume tokens are persisted in
+    resume.json and skip the password check even after a restart, until they
+    expire. Sessions only resume with the context that created them, so the
+    store owns the client context.
+    """
+
+    def __init__(self, path=RESUME_FILE):
+        self.path = path
+        self.sessions = {}
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        # Servers use self-signed certificates, the password / token is what authenticates both ends
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, tokens):
+        os.makedirs(self.path.parent, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f, indent=2)
+
+    def token(self, server):
+        entry = self._load().get(server, {})
+        return entry.get("token") if entry.get("expires", 0) > time.time() else None
+
+    def save_token(self, server, token, ttl):
+        tokens = {name: entry for name, entry in self._load().items() if entry.get("expires", 0) > time.time()}
+        tokens[server] = {"token": token, "expires": int(time.time()) + ttl}
+        self._save(tokens)
+
+    def forget(self, server):
+        self.sessions.pop(server, None)
+        tokens = self._load()
+        if tokens.pop(server, None) is not None:
+            self._save(tokens)
+
+def start_tls_client(server_ip, port=4433, store=None):
+    """ TLS connection to a Diablo server, resuming the previous session with it when the store has one """
+    store = store if store is not None else SessionStore()
+    deadline = time.monotonic() + TLS_TIMEOUT
+    raw_conn = socket.create_connection((server_ip, port), timeout=TLS_TIMEOUT)
+    try:
+        conn = store.context.wrap_socket(raw_conn, server_hostname=server_ip, do_handshake_on_connect=False,
+                                         session=store.sessions.get(f"{server_ip}:{port}"))
+        complete_tls(conn, deadline)
+        conn.setblocking(True)
+        return conn
+    except (OSError, ssl.SSLError, HandshakeError):
+        raw_conn.close()
+        raise
+
+def client_hello(conn, store, server, hello, password=None):
+    """
+    Authenticate with the server and negotiate the tunnel (see
+    handshake.client_handshake). Presents the stored resume token, or the
+    password if there is none, and returns the server's reply. A fresh token
+    and the TLS session are stored for the next reconnect.
+    """
+    token = store.token(server)
+    reply = client_handshake(conn, hello, {"token": token} if token else {"password": password or ""})
+    if reply.get("auth") == "ok":
+        if reply.get("token"):
+            store.save_token(server, reply["token"], reply.get("token_ttl", 0))
+        # TLS 1.3 tickets arrive after the handshake, reading the reply has processed them
+        store.sessions[server] = conn.session
+    elif token:
+        store.forget(server)
+    return reply
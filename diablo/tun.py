@@ -2,39 +2,132 @@ import os
 import platform
 import subprocess
 import fcntl
+import socket
 import struct
 import sys
+import ipaddress
 from .terminal import Terminal 
 
-def setup_tun_interface(ip_addr, netmask, name=None):
+try:
+    from pyroute2 import IPRoute, NetlinkError
+except ImportError:  # only a dependency on Linux, configuration falls back to the ip command
+    IPRoute = None
+
+DEFAULT_MTU = 1400
+MIN_MTU = 576
+MAX_MTU = 9000
+
+SIOCSIFMTU = 0x8922
+TUNSETIFF = 0x400454ca
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+IFF_MULTI_QUEUE = 0x0100
+
+def clamp_mtu(mtu):
+    """ Any MTU from config or a peer, forced into the range the tunnel supports """
+    try:
+        mtu = int(mtu)
+    except (TypeError, ValueError):
+        return DEFAULT_MTU
+    return max(MIN_MTU, min(MAX_MTU, mtu))
+
+def negotiate_mtu(client_mtu, server_mtu):
+    """ Both ends use the smaller of the two MTUs """
+    if client_mtu is None:
+        return clamp_mtu(server_mtu)
+    return min(clamp_mtu(client_mtu), clamp_mtu(server_mtu))
+
+def setup_tun_interface(ip_addr, netmask, name=None, mtu=DEFAULT_MTU):
     system = platform.system()
+    mtu = clamp_mtu(mtu)
 
     if system == 'Linux':
-        return setup_tun_linux(ip_addr, netmask, name or "tun0")
+        return setup_tun_linux(ip_addr, netmask, name or "tun0", mtu)
     elif system == 'Darwin':
-        return setup_tun_macos(ip_addr, netmask)
+        return setup_tun_macos(ip_addr, netmask, mtu)
     elif system == 'Windows':
         raise NotImplementedError("Windows TUN/TAP not yet implemented")
     else:
         raise Exception(f"Unsupported OS: {system}")
 
-def setup_tun_linux(ip_addr, netmask, tun_name):
-    TUNSETIFF = 0x400454ca
-    IFF_TUN = 0x0001
-    IFF_NO_PI = 0x1000
+def setup_tun_multiqueue(ip_addr, netmask, name=None, mtu=DEFAULT_MTU, queues=2):
+    """ Linux only. Interface created with IFF_MULTI_QUEUE, returns one fd per queue """
+    if platform.system() != 'Linux':
+        raise NotImplementedError("Multi-queue TUN devices are only supported on Linux")
+    tun_name = name or "tun0"
+    fds = [open_tun_linux(tun_name, IFF_TUN | IFF_NO_PI | IFF_MULTI_QUEUE) for _ in range(queues)]
+    configure_tun_linux(ip_addr, netmask, tun_name, clamp_mtu(mtu))
+    Terminal.log(f"Linux TUN device {tun_name} has {queues} queues")
+    return fds
+
+def set_mtu_linux(tun_name, mtu):
+    """ SIOCSIFMTU on the interface, no subprocess needed """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        fcntl.ioctl(s.fileno(), SIOCSIFMTU, struct.pack("16si", tun_name.encode(), mtu))
 
+def open_tun_linux(tun_name, flags=IFF_TUN | IFF_NO_PI):
+    """ Attach a new fd to tun_name, with IFF_MULTI_QUEUE every call adds another queue """
     tun_fd = os.open("/dev/net/tun", os.O_RDWR)
-    ifr = struct.pack("16sH", tun_name.encode(), IFF_TUN | IFF_NO_PI)
+    ifr = struct.pack("16sH", tun_name.encode(), flags)
     fcntl.ioctl(tun_fd, TUNSETIFF, ifr)
+    return tun_fd
 
-    # Assign IP and bring interface up
-    subprocess.run(["ip", "addr", "add", f"{ip_addr}/24", "dev", tun_name], check=True)
-    subprocess.run(["ip", "link", "set", tun_name, "up"], check=True)
-
-    Terminal.log(f"Linux TUN device {tun_name} set up at {ip_addr}")
+def setup_tun_linux(ip_addr, netmask, tun_name, mtu=DEFAULT_MTU):
+    tun_fd = open_tun_linux(tun_name)
+    configure_tun_linux(ip_addr, netmask, tun_name, mtu)
     return tun_fd
 
-def setup_tun_macos(ip_addr, netmask):
+def configure_tun_linux(ip_addr, netmask, tun_name, mtu=DEFAULT_MTU):
+    """
+    Assign IP, set MTU and bring interface up. Done in-process over rtnetlink
+    with pyroute2: one request for the address, one for MTU and link state
+    together. The address is replaced rather than added so a reconnect can
+    reconfigure an interface that is already up.
+    """
+    prefix = ipaddress.IPv4Network(f"0.0.0.0/{netmask}").prefixlen
+    if IPRoute is not None:
+        with IPRoute() as ipr:
+            index = _link_index(ipr, tun_name)
+            ipr.addr("replace", index=index, address=ip_addr, prefixlen=prefix)
+            ipr.link("set", index=index, mtu=mtu, state="up")
+    else:
+        subprocess.run(["ip", "addr", "replace", f"{ip_addr}/{prefix}", "dev", tun_name], check=True)
+        set_mtu_linux(tun_name, mtu)
+        subprocess.run(["ip", "link", "set", tun_name, "up"], check=True)
+
+    Terminal.log(f"Linux TUN device {tun_name} set up at {ip_addr} (mtu {mtu})")
+
+def _link_index(ipr, tun_name):
+    indexes = ipr.link_lookup(ifname=tun_name)
+    if not indexes:
+        raise RuntimeError(f"No such interface: {tun_name}")
+    return indexes[0]
+
+def add_route(destination, tun_name, gateway=None):
+    """ Route destination (CIDR) through tun_name, replacing any route already there """
+    if IPRoute is not None:
+        with IPRoute() as ipr:
+            route = {"dst": destination, "oif": _link_index(ipr, tun_name)}
+            if gateway is not None:
+                route["gateway"] = gateway
+            ipr.route("replace", **route)
+    else:
+        via = ["via", gateway] if gateway is not None else []
+        subprocess.run(["ip", "route", "replace", destination, *via, "dev", tun_name], check=True)
+
+def remove_route(destination, tun_name):
+    """ Undo add_route, a route that is already gone is not an error """
+    if IPRoute is not None:
+        with IPRoute() as ipr:
+            try:
+                ipr.route("del", dst=destination, oif=_link_index(ipr, tun_name))
+            except (NetlinkError, RuntimeError):
+                pass
+    else:
+        subprocess.run(["ip", "route", "del", destination, "dev", tun_name], check=False,
+                       stderr=subprocess.DEVNULL)
+
+def setup_tun_macos(ip_addr, netmask, mtu=DEFAULT_MTU):
     # macOS TUNs are /dev/utun[0-255]
     # Let OS pick next available
     for i in range(10):
@@ -49,10 +142,10 @@ def setup_tun_macos(ip_addr, netmask):
 
     # ifconfig to set it up
     subprocess.run([
-        "ifconfig", name, ip_addr, ip_addr, "netmask", netmask, "up"
+        "ifconfig", name, ip_addr, ip_addr, "netmask", netmask, "mtu", str(mtu), "up"
     ], check=True)
 
-    Terminal.log(f"[+] macOS TUN device {name} set up at {ip_addr}")
+    Terminal.log(f"[+] macOS TUN device {name} set up at {ip_addr} (mtu {mtu})")
     return fd
 
 # TODO: Use Wintun.dll, or OpenVPN TAP, or Npcap
\ No newline at end of file
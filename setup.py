@@ -18,4 +18,7 @@ setup(
         'pyroute2; platform_system=="Linux"',
         'argon2-cffi',
     ],
+    extras_require={
+        'lz4': ['lz4'],     # "compression": "lz4", zlib is used without it
+    },
 )